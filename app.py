@@ -3,15 +3,36 @@ import json
 import uuid
 import time
 import base64
+import io
 import sys
 import inspect
 import secrets
+import hashlib
+import threading
+import queue
+import math
+import re
+import tempfile
+import socket
+import ipaddress
 from loguru import logger
 from pathlib import Path
+from urllib.parse import urlparse, urljoin
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 from flask import Flask, request, Response, jsonify, stream_with_context, render_template, redirect, session
 from curl_cffi import requests as curl_requests
+from curl_cffi import CurlOpt
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 class Logger:
@@ -106,22 +127,109 @@ CONFIG = {
         "PICGO_KEY": os.environ.get("PICGO_KEY") or None,
         "TUMY_KEY": os.environ.get("TUMY_KEY") or None,
         "RETRY_TIME": 1000,
-        "PROXY": os.environ.get("PROXY") or None
+        "PROXY": os.environ.get("PROXY") or None,
+        "UPLOAD_CONCURRENCY": int(os.environ.get("UPLOAD_CONCURRENCY", 8))
     },
     "ADMIN": {
         "MANAGER_SWITCH": os.environ.get("MANAGER_SWITCH") or None,
         "PASSWORD": os.environ.get("ADMINPASSWORD") or None 
     },
     "SERVER": {
-        "COOKIE": None,
         "CF_CLEARANCE":os.environ.get("CF_CLEARANCE") or None,
+        "CF_CLEARANCE_POOL": os.environ.get("CF_CLEARANCE_POOL") or None,
+        "CF_CLEARANCE_TTL": int(os.environ.get("CF_CLEARANCE_TTL", 365 * 24)),
+        "CF_CHALLENGE_LIMIT": int(os.environ.get("CF_CHALLENGE_LIMIT", 3)),
         "PORT": int(os.environ.get("PORT", 5200))
     },
+    "TIMEOUTS": {
+        "CONNECT": float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 10)),
+        "FIRST_BYTE": float(os.environ.get("UPSTREAM_FIRST_BYTE_TIMEOUT", 30)),
+        "IDLE": float(os.environ.get("UPSTREAM_IDLE_TIMEOUT", 60)),
+        "DEEPSEARCH_FIRST_BYTE": float(os.environ.get("DEEPSEARCH_FIRST_BYTE_TIMEOUT", 90)),
+        "DEEPSEARCH_IDLE": float(os.environ.get("DEEPSEARCH_IDLE_TIMEOUT", 300)),
+        # 超时的账号暂停使用的秒数，不标记为无效
+        "COOLDOWN": float(os.environ.get("UPSTREAM_TIMEOUT_COOLDOWN", 120))
+    },
+    "HEDGE": {
+        "ENABLED": os.environ.get("HEDGE_REQUESTS", "false").lower() == "true",
+        "PERCENTILE": float(os.environ.get("HEDGE_PERCENTILE", 95)),
+        "MIN_SAMPLES": 20,
+        "DEFAULT_DELAY": float(os.environ.get("HEDGE_DELAY", 8)),
+        "MIN_DELAY": 1.0,
+        "RATIO": float(os.environ.get("HEDGE_RATIO", 0.1)),
+        "BURST": 5,
+        "MIN_REMAINING": int(os.environ.get("HEDGE_MIN_REMAINING", 3))
+    },
+    "CONVERSATION": {
+        "CONTINUATION": os.environ.get("CONVERSATION_CONTINUATION", "false").lower() == "true",
+        "TTL": int(os.environ.get("CONVERSATION_TTL", 3600)),
+        "MAX_ENTRIES": 1000
+    },
+    "UPLOAD_CACHE": {
+        "ENABLED": os.environ.get("UPLOAD_CACHE", "true").lower() == "true",
+        "TTL": int(os.environ.get("UPLOAD_CACHE_TTL", 24 * 60 * 60)),
+        "MAX_ENTRIES": int(os.environ.get("UPLOAD_CACHE_MAX_ENTRIES", 5000)),
+        "FILE": str(DATA_DIR / "upload_cache.json")
+    },
+    "SPOOL": {
+        "THRESHOLD": int(os.environ.get("IMAGE_SPOOL_THRESHOLD", 256 * 1024)),
+        "DIR": os.environ.get("IMAGE_SPOOL_DIR") or tempfile.gettempdir()
+    },
+    "IMAGE": {
+        "COMPRESS": os.environ.get("IMAGE_COMPRESS", "false").lower() == "true",
+        "MAX_SIDE": int(os.environ.get("IMAGE_MAX_SIDE", 2048)),
+        "FORMAT": os.environ.get("IMAGE_FORMAT", "JPEG").upper(),
+        "QUALITY": int(os.environ.get("IMAGE_QUALITY", 85)),
+        "MIN_BYTES": int(os.environ.get("IMAGE_COMPRESS_MIN_BYTES", 100 * 1024))
+    },
+    "IMAGE_FETCH": {
+        "CONCURRENCY": int(os.environ.get("IMAGE_FETCH_CONCURRENCY", 4)),
+        "CONNECT_TIMEOUT": int(os.environ.get("IMAGE_FETCH_CONNECT_TIMEOUT", 5)),
+        "TIMEOUT": int(os.environ.get("IMAGE_FETCH_TIMEOUT", 20)),
+        "MAX_BYTES": int(os.environ.get("IMAGE_FETCH_MAX_BYTES", 20 * 1024 * 1024)),
+        "MAX_REDIRECTS": 3,
+        "CACHE_TTL": int(os.environ.get("IMAGE_FETCH_CACHE_TTL", 600)),
+        "CACHE_BYTES": int(os.environ.get("IMAGE_FETCH_CACHE_BYTES", 32 * 1024 * 1024))
+    },
+    "IDEMPOTENCY": {
+        "ENABLED": os.environ.get("IDEMPOTENCY", "true").lower() == "true",
+        "TTL": int(os.environ.get("IDEMPOTENCY_TTL", 24 * 60 * 60)),
+        "MAX_ENTRIES": int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", 1000)),
+        "MAX_BODY_BYTES": int(os.environ.get("IDEMPOTENCY_MAX_BODY_BYTES", 5 * 1024 * 1024)),
+        "MAX_BYTES": int(os.environ.get("IDEMPOTENCY_MAX_BYTES", 64 * 1024 * 1024)),
+        "DISK": os.environ.get("IDEMPOTENCY_DISK", "false").lower() == "true",
+        "DIR": str(DATA_DIR / "idempotency")
+    },
+    "SINGLE_FLIGHT": {
+        "ENABLED": os.environ.get("SINGLE_FLIGHT", "false").lower() == "true"
+    },
+    "RESPONSE_CACHE": {
+        "ENABLED": os.environ.get("RESPONSE_CACHE", "false").lower() == "true",
+        "TTL": int(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+        # 按模型覆盖有效期，格式 grok-3:600,grok-4:0，0表示该模型不缓存
+        "MODEL_TTL": {
+            item.split(':')[0].strip(): int(item.split(':')[1])
+            for item in os.environ.get("RESPONSE_CACHE_MODEL_TTL", "").split(',') if ':' in item
+        },
+        "MAX_ENTRIES": int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000)),
+        "DISK": os.environ.get("RESPONSE_CACHE_DISK", "false").lower() == "true",
+        "DIR": str(DATA_DIR / "response_cache")
+    },
+    "STREAM": {
+        "COALESCE_MS": int(os.environ.get("SSE_COALESCE_MS", 0)),
+        "COALESCE_BYTES": int(os.environ.get("SSE_COALESCE_BYTES", 2048)),
+        "HEARTBEAT": int(os.environ.get("SSE_HEARTBEAT_INTERVAL", 15))
+    },
+    "CONTEXT": {
+        "INLINE_TOKENS": int(os.environ.get("CONTEXT_INLINE_TOKENS", 10000)),
+        "RECENT_TOKENS": int(os.environ.get("CONTEXT_RECENT_TOKENS", 2000)),
+        "MAX_TOKENS": int(os.environ.get("CONTEXT_MAX_TOKENS", 0))
+    },
     "TOKEN_STATUS_FILE": str(DATA_DIR / "token_status.json"),
+    "CF_CLEARANCE_FILE": str(DATA_DIR / "cf_clearance_pool.json"),
+    "COOKIE_JAR_FILE": str(DATA_DIR / "cookie_jars.json"),
+    "USAGE_FILE": str(DATA_DIR / "usage.json"),
     "SHOW_THINKING": os.environ.get("SHOW_THINKING").lower() == "true",
-    "IS_THINKING": False,
-    "IS_IMG_GEN": False,
-    "IS_IMG_GEN2": False,
     "ISSHOW_SEARCH_RESULTS": os.environ.get("ISSHOW_SEARCH_RESULTS", "true").lower() == "true",
     "IS_SUPER_GROK": os.environ.get("IS_SUPER_GROK", "false").lower() == "true"
 }
@@ -151,6 +259,7 @@ class AuthTokenManager:
         self.token_model_map = {}
         self.expired_tokens = set()
         self.token_status_map = {}
+        self.cooldowns = {}
         self.model_super_config = {
                 "grok-3": {
                     "RequestFrequency": 100,
@@ -288,6 +397,7 @@ class AuthTokenManager:
                 del self.token_status_map[sso]
             
             self.save_token_status()
+            cookie_jar.remove_account(token)
 
             logger.info(f"令牌已成功移除: {token}", "TokenManager")
             return True
@@ -360,11 +470,109 @@ class AuthTokenManager:
             return None
             
         token_entry = self.token_model_map[normalized_model][0]
+        if self.cooldowns and self.is_cooling(normalized_model, token_entry["token"]):
+            # 超时冷却中的账号暂时跳过，顺延到下一个可用账号
+            token_entry = next((entry for entry in self.token_model_map[normalized_model]
+                                if self.is_usable(normalized_model, entry) and not self.is_cooling(normalized_model, entry["token"])), None)
+            if not token_entry:
+                return None
         logger.info(f"使用token: {token_entry['token'][:50]}... (使用次数: {token_entry['RequestCount']}/{token_entry['MaxRequestCount']})", "TokenManager")
         
         if is_return:
             return token_entry["token"]
 
+        return self.consume_token_entry(normalized_model, token_entry)
+
+    def get_token_for_model(self, model_id, token):
+        """使用指定账号（如续聊会话的所属账号），不可用时返回None"""
+        normalized_model = self.normalize_model_name(model_id)
+        token_entry = next((entry for entry in self.token_model_map.get(normalized_model, []) if entry["token"] == token), None)
+        if not token_entry or token_entry["RequestCount"] >= token_entry["MaxRequestCount"]:
+            return None
+        if self.is_cooling(normalized_model, token):
+            return None
+
+        sso = token.split("sso=")[1].split(";")[0]
+        if (sso in self.token_status_map and
+            normalized_model in self.token_status_map[sso] and
+            not self.token_status_map[sso][normalized_model]["isValid"]):
+            return None
+        return self.consume_token_entry(normalized_model, token_entry)
+
+    def get_alternate_token_for_model(self, model_id, exclude_tokens, min_remaining=1):
+        """为对冲请求挑选另一个账号，要求剩余次数不少于min_remaining"""
+        normalized_model = self.normalize_model_name(model_id)
+
+        for token_entry in self.token_model_map.get(normalized_model, []):
+            if token_entry["token"] in exclude_tokens or self.is_cooling(normalized_model, token_entry["token"]):
+                continue
+            sso = token_entry["token"].split("sso=")[1].split(";")[0]
+            if (sso in self.token_status_map and
+                normalized_model in self.token_status_map[sso] and
+                not self.token_status_map[sso][normalized_model]["isValid"]):
+                continue
+            if token_entry["MaxRequestCount"] - token_entry["RequestCount"] < min_remaining:
+                continue
+
+            logger.info(f"对冲使用token: {token_entry['token'][:50]}... (使用次数: {token_entry['RequestCount']}/{token_entry['MaxRequestCount']})", "TokenManager")
+            return self.consume_token_entry(normalized_model, token_entry)
+
+        return None
+
+    def record_cancellation(self, model_id, token):
+        """客户端中途断开导致的取消，单独计数，不影响令牌有效性"""
+        normalized_model = self.normalize_model_name(model_id)
+        logger.warning(f"客户端已断开，已取消上游请求: 模型 {model_id}", "TokenManager")
+
+        try:
+            sso = token.split("sso=")[1].split(";")[0]
+            if sso in self.token_status_map and normalized_model in self.token_status_map[sso]:
+                status = self.token_status_map[sso][normalized_model]
+                status["cancelledCount"] = status.get("cancelledCount", 0) + 1
+                self.save_token_status()
+        except Exception as e:
+            logger.error(f"记录取消请求时出错: {str(e)}", "TokenManager")
+
+    def cool_down_token(self, model_id, token, reason="超时"):
+        """上游超时的账号短暂停用，到期后自动恢复，不影响有效状态"""
+        normalized_model = self.normalize_model_name(model_id)
+        cooldown = CONFIG["TIMEOUTS"]["COOLDOWN"]
+        self.cooldowns[(normalized_model, token)] = time.time() + cooldown
+        logger.warning(f"Token暂停使用{cooldown:g}秒 - 原因: {reason}, Token: {token[:50]}...", "TokenManager")
+
+    def is_cooling(self, normalized_model, token):
+        until = self.cooldowns.get((normalized_model, token))
+        if until is None:
+            return False
+        if until <= time.time():
+            self.cooldowns.pop((normalized_model, token), None)
+            return False
+        return True
+
+    def is_usable(self, normalized_model, token_entry):
+        if token_entry["RequestCount"] >= token_entry["MaxRequestCount"]:
+            return False
+        sso = token_entry["token"].split("sso=")[1].split(";")[0]
+        status = self.token_status_map.get(sso, {}).get(normalized_model)
+        return not status or status["isValid"]
+
+    def refund_token(self, model_id, token):
+        """请求没有发往上游（如准备请求体失败）时退回本次计数"""
+        normalized_model = self.normalize_model_name(model_id)
+
+        try:
+            token_entry = next((entry for entry in self.token_model_map.get(normalized_model, []) if entry["token"] == token), None)
+            if token_entry:
+                token_entry["RequestCount"] = max(0, token_entry["RequestCount"] - 1)
+            sso = token.split("sso=")[1].split(";")[0]
+            if sso in self.token_status_map and normalized_model in self.token_status_map[sso]:
+                status = self.token_status_map[sso][normalized_model]
+                status["totalRequestCount"] = max(0, status["totalRequestCount"] - 1)
+                self.save_token_status()
+        except Exception as e:
+            logger.error(f"退回令牌计数时出错: {str(e)}", "TokenManager")
+
+    def consume_token_entry(self, normalized_model, token_entry):
         if token_entry:
             if token_entry["type"] == "super":
                 self.model_config = self.model_super_config
@@ -560,6 +768,1053 @@ class AuthTokenManager:
     def get_token_status_map(self):
         return self.token_status_map
 
+class CfClearancePool:
+    """cf_clearance与出口IP绑定，按代理维护(proxy, cf_clearance)对"""
+    def __init__(self):
+        self.pool = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_proxy_key(proxy):
+        return proxy or "direct"
+
+    @staticmethod
+    def normalize_proxy(proxy):
+        """配置和接口中的direct或空值表示直连"""
+        proxy = (proxy or '').strip()
+        return None if proxy in ('', 'direct') else proxy
+
+    @staticmethod
+    def normalize_clearance(cf_clearance):
+        if not cf_clearance:
+            return None
+        cf_clearance = cf_clearance.strip().rstrip(';')
+        if not cf_clearance.startswith("cf_clearance="):
+            cf_clearance = f"cf_clearance={cf_clearance}"
+        return cf_clearance
+
+    def save_pool(self):
+        try:
+            with self.lock:
+                pool = {key: dict(entry) for key, entry in self.pool.items()}
+            with open(CONFIG["CF_CLEARANCE_FILE"], 'w', encoding='utf-8') as f:
+                json.dump(pool, f, indent=2, ensure_ascii=False)
+        except Exception as error:
+            logger.error(f"保存cf_clearance池失败: {str(error)}", "CfPool")
+
+    def load_pool(self):
+        try:
+            pool_file = Path(CONFIG["CF_CLEARANCE_FILE"])
+            if pool_file.exists():
+                with open(pool_file, 'r', encoding='utf-8') as f:
+                    self.pool = json.load(f)
+                logger.info(f"已从配置文件加载cf_clearance池: {len(self.pool)}个出口", "CfPool")
+        except Exception as error:
+            logger.error(f"加载cf_clearance池失败: {str(error)}", "CfPool")
+
+    def add_proxy(self, proxy):
+        key = self.get_proxy_key(proxy)
+        with self.lock:
+            if key not in self.pool:
+                self.pool[key] = self._create_entry(proxy, None, None)
+
+    def _create_entry(self, proxy, cf_clearance, ttl_hours):
+        now = int(time.time() * 1000)
+        ttl_hours = ttl_hours if ttl_hours is not None else CONFIG["SERVER"]["CF_CLEARANCE_TTL"]
+        return {
+            "proxy": proxy,
+            "cfClearance": cf_clearance,
+            "isValid": cf_clearance is not None,
+            "updatedTime": now,
+            "expiresAt": now + int(ttl_hours * 60 * 60 * 1000) if cf_clearance else None,
+            "requestCount": 0,
+            "challengeCount": 0,
+            "consecutiveChallenges": 0,
+            "lastChallengeTime": None
+        }
+
+    def set_clearance(self, proxy, cf_clearance, ttl_hours=None, persist=True):
+        key = self.get_proxy_key(proxy)
+        entry = self._create_entry(proxy, self.normalize_clearance(cf_clearance), ttl_hours)
+        with self.lock:
+            self.pool[key] = entry
+        if persist:
+            self.save_pool()
+        logger.info(f"已为出口 {key} 设置cf_clearance", "CfPool")
+
+    def seed_clearance(self, proxy, cf_clearance):
+        """启动时从环境变量载入，与已保存的值相同时保留统计信息"""
+        entry = self.pool.get(self.get_proxy_key(proxy))
+        if entry and entry["cfClearance"] == self.normalize_clearance(cf_clearance):
+            return
+        self.set_clearance(proxy, cf_clearance, persist=False)
+
+    def prune(self, proxies):
+        """只保留当前配置中的出口，已从PROXY或CF_CLEARANCE_POOL删除的出口不再参与轮询"""
+        keys = {self.get_proxy_key(proxy) for proxy in proxies}
+        with self.lock:
+            removed = [key for key in self.pool if key not in keys]
+            for key in removed:
+                del self.pool[key]
+        if removed:
+            logger.info(f"已移除不在配置中的出口: {', '.join(removed)}", "CfPool")
+
+    def remove_proxy(self, proxy):
+        key = self.get_proxy_key(proxy)
+        with self.lock:
+            removed = self.pool.pop(key, None)
+        if removed:
+            self.save_pool()
+        return removed is not None
+
+    def _is_usable(self, entry, now):
+        return (entry["cfClearance"] and entry["isValid"] and
+                (entry["expiresAt"] is None or entry["expiresAt"] > now))
+
+    def get_clearance(self, proxy):
+        now = int(time.time() * 1000)
+        with self.lock:
+            entry = self.pool.get(self.get_proxy_key(proxy))
+            if entry and self._is_usable(entry, now):
+                return entry["cfClearance"]
+        return None
+
+    def get_egress(self, exclude=()):
+        """选择出口：挑战率最低、使用次数最少的代理，并附带其绑定的cf_clearance"""
+        now = int(time.time() * 1000)
+        with self.lock:
+            if not self.pool:
+                return {"proxy": CONFIG["API"]["PROXY"], "cf_clearance": None}
+
+            candidates = [entry for key, entry in self.pool.items() if key not in exclude] or list(self.pool.values())
+            entry = min(candidates, key=lambda item: (
+                item["challengeCount"] / item["requestCount"] if item["requestCount"] else 0,
+                item["requestCount"]
+            ))
+            entry["requestCount"] += 1
+            return {
+                "proxy": entry["proxy"],
+                "cf_clearance": entry["cfClearance"] if self._is_usable(entry, now) else None
+            }
+
+    def record_challenge(self, proxy):
+        key = self.get_proxy_key(proxy)
+        with self.lock:
+            entry = self.pool.get(key)
+            if not entry:
+                return
+            entry["challengeCount"] += 1
+            entry["consecutiveChallenges"] += 1
+            entry["lastChallengeTime"] = int(time.time() * 1000)
+            if entry["isValid"] and entry["consecutiveChallenges"] >= CONFIG["SERVER"]["CF_CHALLENGE_LIMIT"]:
+                entry["isValid"] = False
+                logger.warning(f"出口 {key} 连续触发cf盾{entry['consecutiveChallenges']}次，停用其cf_clearance", "CfPool")
+        self.save_pool()
+
+    def record_success(self, proxy):
+        with self.lock:
+            entry = self.pool.get(self.get_proxy_key(proxy))
+            if entry:
+                entry["consecutiveChallenges"] = 0
+
+    def get_pool_status(self):
+        now = int(time.time() * 1000)
+        with self.lock:
+            return {
+                key: {
+                    "proxy": entry["proxy"],
+                    "hasClearance": bool(entry["cfClearance"]),
+                    "isValid": bool(self._is_usable(entry, now)),
+                    "expiresAt": entry["expiresAt"],
+                    "requestCount": entry["requestCount"],
+                    "challengeCount": entry["challengeCount"],
+                    "challengeRate": round(entry["challengeCount"] / entry["requestCount"], 4) if entry["requestCount"] else 0,
+                    "lastChallengeTime": entry["lastChallengeTime"]
+                }
+                for key, entry in self.pool.items()
+            }
+
+class CookieJarManager:
+    """按账号和出口保存上游下发的Cookie（__cf_bm等），跨请求复用并持久化"""
+    MANAGED_COOKIES = ("sso", "sso-rw", "cf_clearance")
+
+    def __init__(self):
+        self.jars = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_jar_key(token, egress=None):
+        sso = token.split("sso=")[1].split(";")[0] if "sso=" in token else token
+        return f"{sso}|{CfClearancePool.get_proxy_key(egress['proxy'] if egress else CONFIG['API']['PROXY'])}"
+
+    def save_jars(self):
+        try:
+            with self.lock:
+                jars = {key: dict(jar) for key, jar in self.jars.items()}
+            with open(CONFIG["COOKIE_JAR_FILE"], 'w', encoding='utf-8') as f:
+                json.dump(jars, f, indent=2, ensure_ascii=False)
+        except Exception as error:
+            logger.error(f"保存Cookie失败: {str(error)}", "CookieJar")
+
+    def load_jars(self):
+        try:
+            jar_file = Path(CONFIG["COOKIE_JAR_FILE"])
+            if jar_file.exists():
+                with open(jar_file, 'r', encoding='utf-8') as f:
+                    self.jars = json.load(f)
+                logger.info(f"已从配置文件加载Cookie: {len(self.jars)}个账号出口", "CookieJar")
+        except Exception as error:
+            logger.error(f"加载Cookie失败: {str(error)}", "CookieJar")
+
+    def build_cookie(self, token, egress=None):
+        parts = [token]
+        if egress and egress["cf_clearance"]:
+            parts.append(egress["cf_clearance"])
+
+        now = time.time()
+        with self.lock:
+            jar = self.jars.get(self.get_jar_key(token, egress), {})
+            for name in [name for name, item in jar.items() if item["expires"] and item["expires"] <= now]:
+                del jar[name]
+            parts.extend(f"{name}={item['value']}" for name, item in jar.items())
+        return ";".join(parts)
+
+    def update_from_response(self, token, egress, response):
+        try:
+            cookies = [cookie for cookie in response.cookies.jar if cookie.name not in self.MANAGED_COOKIES]
+        except Exception:
+            return
+        if not cookies:
+            return
+
+        changed = False
+        with self.lock:
+            jar = self.jars.setdefault(self.get_jar_key(token, egress), {})
+            for cookie in cookies:
+                item = {"value": cookie.value, "expires": cookie.expires}
+                if jar.get(cookie.name) != item:
+                    jar[cookie.name] = item
+                    changed = True
+        if changed:
+            self.save_jars()
+
+    def remove_account(self, token):
+        prefix = self.get_jar_key(token).split("|")[0] + "|"
+        with self.lock:
+            for key in [key for key in self.jars if key.startswith(prefix)]:
+                del self.jars[key]
+        self.save_jars()
+
+class ConversationCache:
+    """消息前缀哈希 -> (Grok会话ID, 最后一条回复ID, 所属账号)，用于多轮对话续接"""
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def hash_turns(model_id, turns):
+        return hashlib.sha256(json.dumps([model_id, turns], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, model_id, turns):
+        key = self.hash_turns(model_id, turns)
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if entry["expiresAt"] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return {**entry, "key": key}
+
+    def remember(self, attempt, content):
+        # 续聊关闭时turns仍用于估算token，记录的会话不会被使用
+        if not CONFIG["CONVERSATION"]["CONTINUATION"] or attempt.model in ['grok-4-imageGen', 'grok-3-imageGen', 'grok-3-deepsearch']:
+            return
+        if attempt.turns is None or not attempt.conversation_id or not attempt.response_id:
+            return
+        turns = attempt.turns + [["assistant", attempt.client.process_content(content)]]
+        key = self.hash_turns(attempt.client.model_id, turns)
+        with self.lock:
+            self.entries[key] = {
+                "conversationId": attempt.conversation_id,
+                "responseId": attempt.response_id,
+                "token": attempt.token,
+                "expiresAt": time.time() + CONFIG["CONVERSATION"]["TTL"]
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > CONFIG["CONVERSATION"]["MAX_ENTRIES"]:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class UploadCache:
+    """(账号, 内容哈希) -> fileMetadataId，命中时跳过重复上传"""
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(token, content_type, content=None, digest=None):
+        sso = token.split("sso=")[1].split(";")[0] if token and "sso=" in token else str(token)
+        if digest is None:
+            digest = hashlib.sha256(content.encode('utf-8') if isinstance(content, str) else content).hexdigest()
+        return hashlib.sha256(f"{sso}|{content_type}|{digest}".encode('utf-8')).hexdigest()
+
+    def save_cache(self):
+        try:
+            with self.lock:
+                entries = list(self.entries.items())
+            with open(CONFIG["UPLOAD_CACHE"]["FILE"], 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+        except Exception as error:
+            logger.error(f"保存上传缓存失败: {str(error)}", "UploadCache")
+
+    def load_cache(self):
+        try:
+            cache_file = Path(CONFIG["UPLOAD_CACHE"]["FILE"])
+            if cache_file.exists():
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    now = time.time()
+                    self.entries = OrderedDict((key, entry) for key, entry in json.load(f) if entry["expiresAt"] > now)
+                logger.info(f"已从配置文件加载上传缓存: {len(self.entries)}条", "UploadCache")
+        except Exception as error:
+            logger.error(f"加载上传缓存失败: {str(error)}", "UploadCache")
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if entry["expiresAt"] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry["fileMetadataId"]
+
+    def put(self, key, file_id):
+        if not file_id:
+            return
+        with self.lock:
+            self.entries[key] = {
+                "fileMetadataId": file_id,
+                "expiresAt": time.time() + CONFIG["UPLOAD_CACHE"]["TTL"]
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > CONFIG["UPLOAD_CACHE"]["MAX_ENTRIES"]:
+                self.entries.popitem(last=False)
+        self.save_cache()
+
+class ImageSpool:
+    """读取请求体时把超过阈值的data URI图片base64写入临时文件，JSON中只保留spool:<id>占位"""
+    MARKER = b';base64,'
+    BASE64_RUN = re.compile(rb'(?:[A-Za-z0-9+/=]+|\\/)*')
+
+    def __init__(self):
+        self.files = {}
+
+    def read_request(self, stream, chunk_size=64 * 1024):
+        """分块读取请求体，返回去掉大图片数据后的请求体bytes"""
+        threshold = CONFIG["SPOOL"]["THRESHOLD"]
+        body = bytearray()
+        scan = 0
+        pending = None
+        spool_file = None
+        carry = b''
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            chunk = carry + chunk
+            carry = b''
+
+            while chunk:
+                if pending is None and spool_file is None:
+                    body += chunk
+                    chunk = b''
+                    index = body.find(self.MARKER, scan)
+                    if index == -1:
+                        scan = max(0, len(body) - len(self.MARKER) + 1)
+                        continue
+                    scan = index + len(self.MARKER)
+                    if body.rfind(b'data:image/', max(0, index - 128), index) == -1:
+                        continue
+                    chunk = bytes(body[scan:])
+                    del body[scan:]
+                    pending = bytearray()
+                    continue
+
+                end = self.BASE64_RUN.match(chunk).end()
+                if end == len(chunk) - 1 and chunk[end:] == b'\\':
+                    # 转义的"\/"被分块截断，留到下一块再判断
+                    carry = b'\\'
+                    chunk = chunk[:end]
+                if spool_file is None:
+                    pending += chunk[:end]
+                    if len(pending) > threshold:
+                        spool_file, spool_digest = self.open_file(), hashlib.sha256()
+                        self.write_run(spool_file, spool_digest, pending)
+                        pending = None
+                else:
+                    self.write_run(spool_file, spool_digest, chunk[:end])
+                if end >= len(chunk):
+                    break
+                body += self.finish_run(pending, spool_file, spool_digest if spool_file else None)
+                pending = None
+                spool_file = None
+                scan = len(body)
+                chunk = chunk[end:]
+
+        if pending is not None or spool_file is not None:
+            body += self.finish_run(pending, spool_file, spool_digest if spool_file else None)
+        body += carry
+        return bytes(body)
+
+    def finish_run(self, pending, spool_file, digest):
+        """结束一段base64：未超阈值时原样放回请求体，否则返回占位符"""
+        if spool_file is None:
+            return pending
+        spool_file.close()
+        file_id = os.path.basename(spool_file.name)
+        entry = self.files[file_id]
+        entry["digest"] = digest.hexdigest()
+        logger.info(f"图片数据已写入临时文件: {entry['size']}字节", "Server")
+        return f"spool:{file_id}".encode('ascii')
+
+    def open_file(self):
+        spool_file = tempfile.NamedTemporaryFile(prefix="grok2api_", suffix=".b64", dir=CONFIG["SPOOL"]["DIR"], delete=False)
+        self.files[os.path.basename(spool_file.name)] = {"path": spool_file.name, "size": 0, "digest": None}
+        return spool_file
+
+    def write_run(self, spool_file, digest, run):
+        if b'\\' in run:
+            run = run.replace(b'\\/', b'/')
+        spool_file.write(run)
+        digest.update(run)
+        self.files[os.path.basename(spool_file.name)]["size"] += len(run)
+
+    def add(self, content):
+        """把已有的base64数据写入临时文件，返回占位符"""
+        spool_file = self.open_file()
+        digest = hashlib.sha256()
+        self.write_run(spool_file, digest, content)
+        return self.finish_run(None, spool_file, digest).decode('ascii')
+
+    def get(self, base64_data):
+        """data URI占位符 -> 临时文件信息，不是占位符时返回None"""
+        index = base64_data.find(';base64,spool:')
+        if index == -1:
+            return None
+        return self.files.get(base64_data[index + 14:])
+
+    @staticmethod
+    def iter_file(path, prefix, suffix, chunk_size=64 * 1024):
+        yield prefix
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        yield suffix
+
+    def close(self):
+        for entry in self.files.values():
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+        self.files.clear()
+
+class ImageFetcher:
+    """下载http(s)图片转为base64，按URL缓存最近下载的图片"""
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.cache_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def check_url(url):
+        """校验地址并返回CURLOPT_RESOLVE条目，连接时固定使用已校验的IP，避免DNS重绑定"""
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ValueError(f"图片地址无效: {url[:100]}")
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        addresses = [info[4][0].split('%')[0] for info in socket.getaddrinfo(parsed.hostname, port, proto=socket.IPPROTO_TCP)]
+        for address in addresses:
+            if not ipaddress.ip_address(address).is_global:
+                raise ValueError(f"不允许下载内网地址的图片: {parsed.hostname}")
+        address = addresses[0]
+        return f"{parsed.hostname}:{port}:{f'[{address}]' if ':' in address else address}"
+
+    @staticmethod
+    def sniff_mime_type(content):
+        if content.startswith(b'\x89PNG'):
+            return 'image/png'
+        if content.startswith(b'\xff\xd8\xff'):
+            return 'image/jpeg'
+        if content.startswith(b'GIF8'):
+            return 'image/gif'
+        if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+            return 'image/webp'
+        return None
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if not entry:
+                return None
+            if entry["expiresAt"] <= time.time():
+                self.cache_bytes -= len(entry["content"])
+                del self.entries[url]
+                return None
+            self.entries.move_to_end(url)
+            return entry
+
+    def put(self, url, entry):
+        max_bytes = CONFIG["IMAGE_FETCH"]["CACHE_BYTES"]
+        if len(entry["content"]) > max_bytes // 4:
+            return
+        with self.lock:
+            old_entry = self.entries.pop(url, None)
+            if old_entry:
+                self.cache_bytes -= len(old_entry["content"])
+            self.entries[url] = entry
+            self.cache_bytes += len(entry["content"])
+            while self.cache_bytes > max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.cache_bytes -= len(evicted["content"])
+
+    def fetch(self, url, egress=None):
+        """返回{"mimeType", "content"(base64字符串)}，失败时抛出异常"""
+        config = CONFIG["IMAGE_FETCH"]
+        cached = self.get(url)
+        if cached:
+            logger.info(f"命中图片下载缓存: {url[:100]}", "Server")
+            return cached
+
+        start_time = time.time()
+        source_url = url
+        for _ in range(config["MAX_REDIRECTS"] + 1):
+            # 每一跳都重新校验，避免经重定向访问内网
+            resolve = self.check_url(url)
+            response = curl_requests.get(
+                url,
+                headers={"Accept": "image/*"},
+                curl_options={CurlOpt.RESOLVE: [resolve]},
+                impersonate="chrome133a",
+                stream=True,
+                allow_redirects=False,
+                timeout=(config["CONNECT_TIMEOUT"], config["TIMEOUT"]),
+                **Utils.get_proxy_options(egress)
+            )
+            location = response.headers.get('location')
+            if response.status_code not in self.REDIRECT_CODES or not location:
+                break
+            response.close()
+            url = urljoin(url, location)
+        else:
+            raise ValueError(f"图片地址重定向次数过多: {source_url[:100]}")
+
+        try:
+            if response.status_code != 200:
+                raise ValueError(f"下载图片失败,状态码:{response.status_code}")
+            if int(response.headers.get('content-length') or 0) > config["MAX_BYTES"]:
+                raise ValueError(f"图片超过大小上限{config['MAX_BYTES']}字节")
+            content = bytearray()
+            for chunk in response.iter_content():
+                content += chunk
+                if len(content) > config["MAX_BYTES"]:
+                    raise ValueError(f"图片超过大小上限{config['MAX_BYTES']}字节")
+                if time.time() - start_time > config["TIMEOUT"]:
+                    raise ValueError(f"下载图片超时: {source_url[:100]}")
+        finally:
+            response.close()
+
+        mime_type = (response.headers.get('content-type') or '').split(';')[0].strip().lower()
+        if not mime_type.startswith('image/'):
+            mime_type = self.sniff_mime_type(content)
+            if not mime_type:
+                raise ValueError(f"下载内容不是图片: {source_url[:100]}")
+
+        entry = {
+            "mimeType": mime_type,
+            "content": base64.b64encode(content).decode('ascii'),
+            "expiresAt": time.time() + config["CACHE_TTL"]
+        }
+        logger.info(f"下载图片成功: {len(content)}字节，耗时{(time.time() - start_time) * 1000:.0f}ms", "Server")
+        self.put(source_url, entry)
+        return entry
+
+class ImageCompressor:
+    """上传前在本地缩放并重新编码图片，去掉EXIF等元数据；需要安装Pillow"""
+    MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+    @staticmethod
+    def compress(base64_data, mime_type):
+        """返回(base64字符串, mimeType)，无需处理或处理后没有变小时返回None"""
+        config = CONFIG["IMAGE"]
+        if Image is None:
+            logger.warning("未安装Pillow，跳过图片压缩", "Server")
+            return None
+        if mime_type == 'image/gif' or config["FORMAT"] not in ImageCompressor.MIME_TYPES:
+            return None
+        raw = base64.b64decode(base64_data)
+        if len(raw) < config["MIN_BYTES"]:
+            return None
+
+        start_time = time.time()
+        try:
+            with Image.open(io.BytesIO(raw)) as image:
+                max_side = config["MAX_SIDE"]
+                if image.format == 'JPEG':
+                    # JPEG可直接按1/2、1/4…解码，避免先解出全尺寸像素
+                    image.draft('RGB', (max_side, max_side))
+                image = ImageOps.exif_transpose(image)
+                resized = max(image.size) > max_side
+                if resized:
+                    image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+                resized_image = image
+                if config["FORMAT"] == 'JPEG' and (image.mode in ('RGBA', 'LA') or 'transparency' in image.info):
+                    image = image.convert('RGBA')
+                    background = Image.new('RGB', image.size, (255, 255, 255))
+                    background.paste(image, mask=image.getchannel('A'))
+                    image = background
+                elif config["FORMAT"] == 'JPEG' and image.mode != 'RGB':
+                    image = image.convert('RGB')
+
+                output = io.BytesIO()
+                image.save(output, format=config["FORMAT"], quality=config["QUALITY"], optimize=True)
+                compressed, output_format = output.getvalue(), config["FORMAT"]
+                if len(compressed) >= len(raw) and resized and config["FORMAT"] != 'PNG':
+                    # 文字截图等内容有损格式反而更大，缩放后仍用PNG无损编码
+                    output = io.BytesIO()
+                    resized_image.save(output, format='PNG', optimize=True)
+                    if len(output.getvalue()) < len(compressed):
+                        compressed, output_format = output.getvalue(), 'PNG'
+        except Exception as error:
+            logger.warning(f"图片压缩失败，使用原图上传: {str(error)}", "Server")
+            return None
+
+        if len(compressed) >= len(raw):
+            return None
+        logger.info(f"图片已压缩: {len(raw)}字节 -> {len(compressed)}字节，耗时{(time.time() - start_time) * 1000:.0f}ms", "Server")
+        return base64.b64encode(compressed).decode('ascii'), ImageCompressor.MIME_TYPES[output_format]
+
+class UsageTracker:
+    """按API密钥和账号累计估算的token用量，用于容量规划"""
+    def __init__(self):
+        self.usage = {"keys": {}, "accounts": {}}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def mask_key(key):
+        if not key:
+            return "unknown"
+        return key if len(key) <= 12 else f"{key[:6]}...{key[-4:]}"
+
+    @staticmethod
+    def build_usage(prompt_tokens, completion_tokens):
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+
+    def save_usage(self):
+        try:
+            with self.lock:
+                usage = json.dumps(self.usage, ensure_ascii=False)
+            with open(CONFIG["USAGE_FILE"], 'w', encoding='utf-8') as f:
+                f.write(usage)
+        except Exception as error:
+            logger.error(f"保存用量统计失败: {str(error)}", "Usage")
+
+    def load_usage(self):
+        try:
+            usage_file = Path(CONFIG["USAGE_FILE"])
+            if usage_file.exists():
+                with open(usage_file, 'r', encoding='utf-8') as f:
+                    self.usage = {"keys": {}, "accounts": {}, **json.load(f)}
+                logger.info(f"已从配置文件加载用量统计: {len(self.usage['keys'])}个密钥，{len(self.usage['accounts'])}个账号", "Usage")
+        except Exception as error:
+            logger.error(f"加载用量统计失败: {str(error)}", "Usage")
+
+    def record(self, api_key, token, model, usage):
+        sso = token.split("sso=")[1].split(";")[0] if token and "sso=" in token else "unknown"
+        with self.lock:
+            for bucket, name in (("keys", self.mask_key(api_key)), ("accounts", sso)):
+                entry = self.usage[bucket].setdefault(name, {"requests": 0, "promptTokens": 0, "completionTokens": 0, "models": {}})
+                entry["requests"] += 1
+                entry["promptTokens"] += usage["prompt_tokens"]
+                entry["completionTokens"] += usage["completion_tokens"]
+                entry["models"][model] = entry["models"].get(model, 0) + usage["total_tokens"]
+        self.save_usage()
+
+    def get_usage(self):
+        with self.lock:
+            return json.loads(json.dumps(self.usage))
+
+class ResponseRecord:
+    """一次对话响应的输出记录：进行中时其他请求可挂接并跟随读取，完成后可整体重放"""
+    __slots__ = ("fingerprint", "events", "size", "done", "status_code", "content_type", "storable", "expires_at", "condition")
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.events = []
+        self.size = 0
+        self.done = False
+        self.status_code = 200
+        # 响应头确定前为None，挂接的请求等到此时才决定按流式还是整体返回
+        self.content_type = None
+        self.storable = True
+        self.expires_at = 0
+        self.condition = threading.Condition()
+
+    def append(self, data):
+        with self.condition:
+            self.events.append(data)
+            self.size += len(data)
+            self.condition.notify_all()
+
+    def start(self, status_code, content_type):
+        with self.condition:
+            self.status_code = status_code
+            self.content_type = content_type
+            self.condition.notify_all()
+
+    def finish(self, status_code, content_type, storable=True):
+        with self.condition:
+            self.status_code = status_code
+            self.content_type = content_type
+            self.storable = self.storable and storable
+            self.done = True
+            self.condition.notify_all()
+
+    def get_body(self):
+        with self.condition:
+            return b''.join(self.events)
+
+    def iter_events(self, heartbeat=0):
+        """从头读取输出，未完成时等待后续内容，等待期间按间隔输出SSE注释心跳"""
+        index = 0
+        while True:
+            with self.condition:
+                if index >= len(self.events) and not self.done:
+                    self.condition.wait(timeout=heartbeat or None)
+                pending = self.events[index:]
+                index += len(pending)
+                finished = self.done and index >= len(self.events)
+            if pending:
+                yield b''.join(pending)
+            elif not finished and heartbeat:
+                yield b": keep-alive\n\n"
+            if finished:
+                return
+
+    def wait(self):
+        with self.condition:
+            while not self.done:
+                self.condition.wait()
+
+    def to_dict(self):
+        return {
+            "fingerprint": self.fingerprint,
+            "statusCode": self.status_code,
+            "contentType": self.content_type,
+            "expiresAt": self.expires_at,
+            "body": self.get_body().decode('utf-8')
+        }
+
+    @staticmethod
+    def from_dict(data):
+        record = ResponseRecord(data["fingerprint"])
+        record.events = [data["body"].encode('utf-8')]
+        record.size = len(record.events[0])
+        record.status_code = data["statusCode"]
+        record.content_type = data["contentType"]
+        record.expires_at = data["expiresAt"]
+        record.done = True
+        return record
+
+    def build_response(self, heartbeat=0):
+        with self.condition:
+            while self.content_type is None:
+                self.condition.wait()
+        if self.content_type.startswith('text/event-stream'):
+            return Response(self.iter_events(heartbeat), status=self.status_code, content_type=self.content_type)
+        self.wait()
+        return Response(self.get_body(), status=self.status_code, content_type=self.content_type)
+
+class IdempotencyStore:
+    """Idempotency-Key -> 响应记录。进行中的重复请求挂接同一上游输出，完成后在TTL内重放；内存LRU，可选落盘"""
+    SWEEP_INTERVAL = 60 * 60
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_sweep = 0
+
+    @staticmethod
+    def get_key(api_key, idempotency_key):
+        return hashlib.sha256(f"{api_key}|{idempotency_key}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_fingerprint(data, spool=None):
+        """请求体的规范化哈希；临时文件占位符替换为图片内容哈希，重试时结果一致"""
+        canonical = json.dumps(data, sort_keys=True, ensure_ascii=False)
+        if spool and spool.files:
+            canonical = re.sub(r'spool:([\w.-]+)', lambda match: spool.files.get(match.group(1), {}).get("digest") or match.group(0), canonical)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return Path(CONFIG["IDEMPOTENCY"]["DIR"]) / f"{key}.json"
+
+    def load_record(self, key):
+        if not CONFIG["IDEMPOTENCY"]["DISK"]:
+            return None
+        path = self.get_path(key)
+        try:
+            if not path.exists():
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                record = ResponseRecord.from_dict(json.load(f))
+            if record.expires_at <= time.time():
+                path.unlink()
+                return None
+            return record
+        except Exception as error:
+            logger.error(f"读取幂等记录失败: {str(error)}", "Idempotency")
+            return None
+
+    def save_record(self, key, record):
+        if not CONFIG["IDEMPOTENCY"]["DISK"]:
+            return
+        try:
+            path = self.get_path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(record.to_dict(), f, ensure_ascii=False)
+        except Exception as error:
+            logger.error(f"保存幂等记录失败: {str(error)}", "Idempotency")
+
+    def delete_records(self, keys):
+        if not CONFIG["IDEMPOTENCY"]["DISK"]:
+            return
+        for key in keys:
+            try:
+                self.get_path(key).unlink()
+            except FileNotFoundError:
+                continue
+            except Exception as error:
+                logger.error(f"删除幂等记录失败: {str(error)}", "Idempotency")
+
+    def sweep_disk(self):
+        """启动时及之后每小时清理一次落盘记录：删除过期文件，文件数超过IDEMPOTENCY_MAX_ENTRIES时删除最旧的"""
+        config = CONFIG["IDEMPOTENCY"]
+        self.last_sweep = time.time()
+        if not config["DISK"]:
+            return
+        removed = Utils.sweep_directory(config["DIR"], config["TTL"], config["MAX_ENTRIES"])
+        if removed:
+            logger.info(f"已清理{removed}个落盘幂等记录", "Idempotency")
+
+    def begin(self, key, fingerprint):
+        """返回(记录, 是否由本请求执行)；同一密钥对应不同请求体时返回(None, False)"""
+        with self.lock:
+            record = self.entries.get(key)
+            if record and record.done and record.expires_at <= time.time():
+                del self.entries[key]
+                self.delete_records((key,))
+                record = None
+            if record is None:
+                record = self.load_record(key)
+                if record:
+                    self.entries[key] = record
+            if record:
+                self.entries.move_to_end(key)
+                if record.fingerprint != fingerprint:
+                    return None, False
+                return record, False
+
+            record = ResponseRecord(fingerprint)
+            self.entries[key] = record
+            return record, True
+
+    def complete(self, key, record):
+        """记录完成后按是否可存储决定保留或移除；失败的请求不保留，允许客户端重试"""
+        config = CONFIG["IDEMPOTENCY"]
+        with self.lock:
+            if not record.storable or record.size > config["MAX_BODY_BYTES"]:
+                if self.entries.get(key) is record:
+                    del self.entries[key]
+                return
+            record.expires_at = time.time() + config["TTL"]
+            # 按条数和总字节数淘汰，只淘汰已完成的记录，进行中的记录还有请求在读取
+            total_bytes = sum(entry.size for entry in self.entries.values() if entry.done)
+            evicted_keys = []
+            for evict_key, evicted in list(self.entries.items()):
+                if len(self.entries) <= config["MAX_ENTRIES"] and total_bytes <= config["MAX_BYTES"]:
+                    break
+                if evicted.done:
+                    del self.entries[evict_key]
+                    total_bytes -= evicted.size
+                    evicted_keys.append(evict_key)
+        self.delete_records(evicted_keys)
+        if key in evicted_keys:
+            return
+        self.save_record(key, record)
+        if time.time() - self.last_sweep > self.SWEEP_INTERVAL:
+            self.sweep_disk()
+
+class SingleFlight:
+    """相同的并发非流式请求只发起一次上游调用，结果分发给所有等待者；完成后立即移除，不做缓存"""
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(api_key, data, spool=None):
+        return IdempotencyStore.get_fingerprint({
+            "apiKey": api_key,
+            "model": data["model"],
+            "messages": data["messages"]
+        }, spool)
+
+    def begin(self, key):
+        """返回(记录, 是否由本请求执行)"""
+        with self.lock:
+            record = self.calls.get(key)
+            if record:
+                return record, False
+            record = ResponseRecord(key)
+            self.calls[key] = record
+            return record, True
+
+    def complete(self, key, record):
+        with self.lock:
+            if self.calls.get(key) is record:
+                del self.calls[key]
+
+class ResponseCache:
+    """精确匹配的回复缓存：(密钥, 模型, 实际发送的消息, 图片内容) -> 回复文本；内存LRU，可选落盘"""
+    SWEEP_INTERVAL = 60 * 60
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_sweep = 0
+
+    @staticmethod
+    def get_ttl(model):
+        config = CONFIG["RESPONSE_CACHE"]
+        if not config["ENABLED"] or 'imageGen' in model:
+            return 0
+        return config["MODEL_TTL"].get(model, config["TTL"])
+
+    @staticmethod
+    def get_key(api_key, grok_client, request, spool=None):
+        """按扁平化前的逐条消息文本计算，与prepare_chat_request发送的内容一一对应；最后一条消息的图片按内容哈希"""
+        turns = grok_client.turns if grok_client.turns is not None else grok_client.build_turns(request)
+        if request["model"] in ['grok-4-imageGen', 'grok-3-imageGen', 'grok-3-deepsearch']:
+            turns = turns[-1:]
+        images = []
+        for image_url in grok_client.get_image_urls(request["messages"][-1].get("content"))[:4]:
+            spooled = spool.get(image_url) if spool else None
+            images.append(spooled["digest"] if spooled else hashlib.sha256(image_url.encode('utf-8')).hexdigest())
+        canonical = json.dumps({
+            "apiKey": api_key,
+            "model": request["model"],
+            "turns": turns,
+            "images": images
+        }, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return Path(CONFIG["RESPONSE_CACHE"]["DIR"]) / f"{key}.json"
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry["expiresAt"] <= time.time():
+                del self.entries[key]
+                entry = None
+                self.delete_files((key,))
+            if entry:
+                self.entries.move_to_end(key)
+                return entry["content"]
+
+        if not CONFIG["RESPONSE_CACHE"]["DISK"]:
+            return None
+        path = self.get_path(key)
+        try:
+            if not path.exists():
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry["expiresAt"] <= time.time():
+                path.unlink()
+                return None
+        except Exception as error:
+            logger.error(f"读取回复缓存失败: {str(error)}", "ResponseCache")
+            return None
+        self.remember(key, entry)
+        return entry["content"]
+
+    def remember(self, key, entry):
+        evicted_keys = []
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > CONFIG["RESPONSE_CACHE"]["MAX_ENTRIES"]:
+                evicted_keys.append(self.entries.popitem(last=False)[0])
+        self.delete_files(evicted_keys)
+
+    def delete_files(self, keys):
+        if not CONFIG["RESPONSE_CACHE"]["DISK"]:
+            return
+        for key in keys:
+            try:
+                self.get_path(key).unlink()
+            except FileNotFoundError:
+                continue
+            except Exception as error:
+                logger.error(f"删除回复缓存失败: {str(error)}", "ResponseCache")
+
+    def sweep_disk(self):
+        """启动时及之后每小时清理一次落盘缓存：删除过期文件，文件数超过RESPONSE_CACHE_MAX_ENTRIES时删除最旧的"""
+        config = CONFIG["RESPONSE_CACHE"]
+        self.last_sweep = time.time()
+        if not config["DISK"]:
+            return
+        max_age = max([config["TTL"], *config["MODEL_TTL"].values()])
+        removed = Utils.sweep_directory(config["DIR"], max_age, config["MAX_ENTRIES"])
+        if removed:
+            logger.info(f"已清理{removed}个落盘回复缓存", "ResponseCache")
+
+    def put(self, key, model, content):
+        ttl = self.get_ttl(model)
+        if not ttl or not content:
+            return
+        entry = {"content": content, "expiresAt": time.time() + ttl}
+        self.remember(key, entry)
+        if not CONFIG["RESPONSE_CACHE"]["DISK"]:
+            return
+        try:
+            path = self.get_path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+        except Exception as error:
+            logger.error(f"保存回复缓存失败: {str(error)}", "ResponseCache")
+        if time.time() - self.last_sweep > self.SWEEP_INTERVAL:
+            self.sweep_disk()
+
 class Utils:
     @staticmethod
     def organize_search_results(search_results):
@@ -579,13 +1834,142 @@ class Utils:
 
         return '\n\n'.join(formatted_results)
 
+    @staticmethod
+    def decode_json(raw):
+        if orjson is not None:
+            return orjson.loads(raw)
+        return json.loads(raw)
+
+    @staticmethod
+    def validate_chat_request(data):
+        """校验对话请求结构，返回错误信息，合法时返回None"""
+        if not isinstance(data, dict):
+            return "请求体必须是JSON对象"
+        if not isinstance(data.get("model"), str) or data["model"] not in CONFIG["MODELS"]:
+            return f"不支持的模型: {data.get('model')}"
+        if not isinstance(data.get("stream", False), bool):
+            return "stream必须是布尔值"
+        if data.get("stream_options") is not None and not isinstance(data["stream_options"], dict):
+            return "stream_options必须是对象"
+        if not isinstance((data.get("stream_options") or {}).get("include_usage", False), bool):
+            return "stream_options.include_usage必须是布尔值"
+        coalesce_ms = (data.get("stream_options") or {}).get("coalesce_ms", 0)
+        if not isinstance(coalesce_ms, int) or isinstance(coalesce_ms, bool) or not 0 <= coalesce_ms <= 1000:
+            return "stream_options.coalesce_ms必须是0到1000之间的整数"
+
+        messages = data.get("messages")
+        if not isinstance(messages, list) or not messages:
+            return "messages必须是非空数组"
+        # 单消息模型只发送最后一条，其余模型任一消息有文本或图片即可
+        first_sent = len(messages) - 1 if data["model"] in ['grok-4-imageGen', 'grok-3-imageGen', 'grok-3-deepsearch'] else 0
+        has_content = False
+        for index, message in enumerate(messages):
+            if not isinstance(message, dict) or not isinstance(message.get("role"), str):
+                return f"messages[{index}]缺少role"
+            content = message.get("content")
+            if content is None or isinstance(content, str):
+                # 助手的工具调用等消息content为null
+                has_content = has_content or (index >= first_sent and bool(content and content.strip()))
+                continue
+            parts = content if isinstance(content, list) else [content]
+            if not isinstance(content, (list, dict)):
+                return f"messages[{index}].content类型不正确"
+            for part in parts:
+                if not isinstance(part, dict):
+                    return f"messages[{index}].content类型不正确"
+                if part.get("type") == 'text':
+                    if not isinstance(part.get("text"), str):
+                        return f"messages[{index}]的text内容必须是字符串"
+                    has_content = has_content or (index >= first_sent and bool(part["text"].strip()))
+                elif part.get("type") == 'image_url':
+                    image_url = part.get("image_url")
+                    if not isinstance(image_url, dict) or not isinstance(image_url.get("url"), str):
+                        return f"messages[{index}]的image_url缺少url"
+                    if not image_url["url"].startswith(('data:', 'http://', 'https://')):
+                        return f"messages[{index}]的image_url只支持data URI或http(s)地址"
+                    has_content = has_content or index >= first_sent
+                else:
+                    return f"messages[{index}]包含不支持的内容类型: {part.get('type')}"
+        if not has_content:
+            return '消息内容为空!'
+
+        if data["model"] in ['grok-4-imageGen', 'grok-3-imageGen', 'grok-3-deepsearch'] and messages[-1]["role"] != 'user':
+            return '此模型最后一条消息必须是用户消息!'
+        if (data["model"] in ['grok-4-imageGen', 'grok-3-imageGen'] and
+            not CONFIG["API"]["PICGO_KEY"] and not CONFIG["API"]["TUMY_KEY"] and
+            data.get("stream", False)):
+            return "该模型流式输出需要配置PICGO或者TUMY图床密钥!"
+        return None
+
     @staticmethod
     def create_auth_headers(model, is_return=False):
         return token_manager.get_next_token_for_model(model, is_return)
 
     @staticmethod
-    def get_proxy_options():
-        proxy = CONFIG["API"]["PROXY"]
+    def create_cookie(token, egress=None):
+        return cookie_jar.build_cookie(token, egress)
+
+    @staticmethod
+    def store_cookies(token, egress, response):
+        cookie_jar.update_from_response(token, egress, response)
+
+    @staticmethod
+    def sweep_directory(directory, max_age, max_files):
+        """删除目录中修改时间超过max_age秒的json文件，剩余超过max_files个时删除最旧的，返回删除数"""
+        path = Path(directory)
+        if not path.exists():
+            return 0
+        now = time.time()
+        removed = 0
+        files = []
+        for file in path.glob('*.json'):
+            try:
+                mtime = file.stat().st_mtime
+                if mtime + max_age <= now:
+                    file.unlink()
+                    removed += 1
+                else:
+                    files.append((mtime, file))
+            except OSError:
+                continue
+        files.sort()
+        for _, file in files[:max(0, len(files) - max_files)]:
+            try:
+                file.unlink()
+                removed += 1
+            except OSError:
+                continue
+        return removed
+
+    @staticmethod
+    def is_cf_challenge(response):
+        if response.status_code not in (403, 503):
+            return False
+        if response.headers.get("cf-mitigated") == "challenge":
+            return True
+        try:
+            return "Just a moment" in response.text[:2048]
+        except Exception:
+            return False
+
+    @staticmethod
+    def get_upstream_timeouts(model):
+        timeouts = CONFIG["TIMEOUTS"]
+        if 'deepsearch' in model or 'deepersearch' in model:
+            return {
+                "connect": timeouts["CONNECT"],
+                "first_byte": timeouts["DEEPSEARCH_FIRST_BYTE"],
+                "idle": timeouts["DEEPSEARCH_IDLE"]
+            }
+        return {
+            "connect": timeouts["CONNECT"],
+            "first_byte": timeouts["FIRST_BYTE"],
+            "idle": timeouts["IDLE"]
+        }
+
+    @staticmethod
+    def get_proxy_options(egress=None):
+        proxy = egress["proxy"] if egress else CONFIG["API"]["PROXY"]
         proxy_options = {}
 
         if proxy:
@@ -603,22 +1987,143 @@ class Utils:
                 proxy_options["proxies"] = {"https": proxy, "http": proxy}     
         return proxy_options
 
+class ContextPacker:
+    """按估算token数决定历史消息内联、溢出到message.txt或裁剪"""
+    @staticmethod
+    def estimate_tokens(text):
+        """快速估算：ASCII约4字符1个token，CJK等多字节字符约1字符1个token。
+        UTF-8下ASCII占1字节、CJK占3字节，可由字节数与字符数之差得出多字节字符数"""
+        if not text:
+            return 0
+        char_count = len(text)
+        if text.isascii():
+            return (char_count + 3) // 4
+        wide_count = min(char_count, (len(text.encode('utf-8')) - char_count) // 2)
+        return (char_count - wide_count + 3) // 4 + wide_count
+
+    @staticmethod
+    def render(segments):
+        """拼接为"ROLE: 内容"格式，相邻同角色的消息合并到同一段"""
+        parts = []
+        last_role = None
+        for role, text, mergeable in segments:
+            if role == last_role and mergeable:
+                parts.append('\n')
+                parts.append(text)
+                continue
+            if parts:
+                parts.append('\n')
+            parts.append(f"{role.upper()}: {text}")
+            last_role = role
+        if parts:
+            parts.append('\n')
+        return ''.join(parts)
+
+    @staticmethod
+    def pack(segments):
+        """返回(溢出段, 内联段, 裁剪段数)，溢出段为最旧的部分"""
+        config = CONFIG["CONTEXT"]
+        token_counts = [ContextPacker.estimate_tokens(text) + 2 for _, text, _ in segments]
+        total_tokens = sum(token_counts)
+        if total_tokens <= config["INLINE_TOKENS"]:
+            return [], segments, 0
+
+        trimmed = 0
+        if config["MAX_TOKENS"]:
+            while trimmed < len(segments) - 1 and total_tokens > config["MAX_TOKENS"]:
+                total_tokens -= token_counts[trimmed]
+                trimmed += 1
+            if total_tokens <= config["INLINE_TOKENS"]:
+                return [], segments[trimmed:], trimmed
+
+        split_index = len(segments)
+        inline_tokens = 0
+        while split_index > trimmed and inline_tokens + token_counts[split_index - 1] <= config["RECENT_TOKENS"]:
+            split_index -= 1
+            inline_tokens += token_counts[split_index]
+        return segments[trimmed:split_index], segments[split_index:], trimmed
+
 class GrokApiClient:
     def __init__(self, model_id):
         if model_id not in CONFIG["MODELS"]:
             raise ValueError(f"不支持的模型: {model_id}")
         self.model_id = CONFIG["MODELS"][model_id]
+        self.egress = cf_pool.get_egress()
+        self.turns = None
+        self.continuation = None
+        self.request_payload = None
+        self.token = None
+        self.spool = None
+        self.image_fetches = {}
 
     def process_message_content(self, content):
         if isinstance(content, str):
             return content
-        return None
+        return ''
+
+    # 移除<think>标签及其内容和base64图片
+    @staticmethod
+    def remove_think_tags(text):
+        """单次扫描移除<think>块，并把内联data URI图片替换为[图片]，图片数据本身不做拷贝"""
+        if '<think>' not in text and '![image](data:' not in text:
+            return text.strip()
+
+        parts = []
+        position = 0
+        next_think = text.find('<think>')
+        next_image = text.find('![image](data:')
+        while True:
+            if 0 <= next_think < position:
+                next_think = text.find('<think>', position)
+            if 0 <= next_image < position:
+                next_image = text.find('![image](data:', position)
+            if next_think == -1 and next_image == -1:
+                break
+
+            if next_image == -1 or 0 <= next_think < next_image:
+                end = text.find('</think>', next_think + 7)
+                if end == -1:
+                    next_think = -1
+                    continue
+                parts.append(text[position:next_think])
+                position = end + 8
+                continue
+
+            base64_start = text.find('base64,', next_image + 14)
+            end = text.find(')', base64_start + 7) if base64_start != -1 else -1
+            if end == -1 or text.find('\n', next_image, end) != -1:
+                next_image = text.find('![image](data:', next_image + 1)
+                continue
+            parts.append(text[position:next_image])
+            parts.append('[图片]')
+            position = end + 1
+
+        parts.append(text[position:])
+        return ''.join(parts).strip()
+
+    def process_content(self, content):
+        remove_think_tags = self.remove_think_tags
+        if isinstance(content, list):
+            text_content = ''
+            for item in content:
+                if item["type"] == 'image_url':
+                    text_content += ("[图片]" if not text_content else '\n[图片]')
+                elif item["type"] == 'text':
+                    text_content += (remove_think_tags(item["text"]) if not text_content else '\n' + remove_think_tags(item["text"]))
+            return text_content
+        elif isinstance(content, dict) and content is not None:
+            if content["type"] == 'image_url':
+                return "[图片]"
+            elif content["type"] == 'text':
+                return remove_think_tags(content["text"])
+        return remove_think_tags(self.process_message_content(content))
 
     def get_image_type(self, base64_string):
         mime_type = 'image/jpeg'
-        if 'data:image' in base64_string:
-            import re
-            matches = re.search(r'data:([a-zA-Z0-9]+\/[a-zA-Z0-9-.+]+);base64,', base64_string)
+        # 只看data URI头部，不扫描整段base64
+        header = base64_string[:128]
+        if header.startswith('data:image'):
+            matches = re.match(r'data:([a-zA-Z0-9]+\/[a-zA-Z0-9-.+]+);base64,', header)
             if matches:
                 mime_type = matches.group(1)
 
@@ -631,6 +2136,15 @@ class GrokApiClient:
         }
     def upload_base64_file(self, message, model):
         try:
+            token = self.token
+            cache_key = None
+            if CONFIG["UPLOAD_CACHE"]["ENABLED"]:
+                cache_key = UploadCache.get_key(token, "text/plain", message)
+                file_id = upload_cache.get(cache_key)
+                if file_id:
+                    logger.info(f"命中上传缓存，跳过文字文件上传: {file_id}", "Server")
+                    return file_id
+
             message_base64 = base64.b64encode(message.encode('utf-8')).decode('utf-8')
             upload_data = {
                 "fileName": "message.txt",
@@ -639,18 +2153,18 @@ class GrokApiClient:
             }
 
             logger.info("发送文字文件请求", "Server")
-            cookie = f"{Utils.create_auth_headers(model, True)};{CONFIG['SERVER']['CF_CLEARANCE']}" 
-            proxy_options = Utils.get_proxy_options()
+            proxy_options = Utils.get_proxy_options(self.egress)
             response = curl_requests.post(
                 "https://grok.com/rest/app-chat/upload-file",
                 headers={
                     **DEFAULT_HEADERS,
-                    "Cookie":cookie
+                    "Cookie":Utils.create_cookie(token, self.egress)
                 },
                 json=upload_data,
                 impersonate="chrome133a",
                 **proxy_options
             )
+            Utils.store_cookies(token, self.egress, response)
 
             if response.status_code != 200:
                 logger.error(f"上传文件失败,状态码:{response.status_code}", "Server")
@@ -658,14 +2172,42 @@ class GrokApiClient:
 
             result = response.json()
             logger.info(f"上传文件成功: {result}", "Server")
+            if cache_key:
+                upload_cache.put(cache_key, result.get("fileMetadataId", ""))
             return result.get("fileMetadataId", "")
 
         except Exception as error:
             logger.error(str(error), "Server")
             raise Exception(f"上传文件失败,状态码:{response.status_code}")
-    def upload_base64_image(self, base64_data, url):
+    def prefetch_images(self, request):
+        """请求解析后立即开始下载最后一条消息中的远程图片，与获取token、处理历史消息并行"""
+        for image_url in self.get_image_urls(request["messages"][-1].get("content"))[:4]:
+            if image_url.startswith(('http://', 'https://')) and image_url not in self.image_fetches:
+                self.image_fetches[image_url] = fetch_executor.submit(image_fetcher.fetch, image_url, self.egress)
+
+    def fetch_remote_image(self, image_url):
+        """远程图片 -> data URI，较大的图片写入临时文件；失败返回None"""
         try:
-            if 'data:image' in base64_data:
+            future = self.image_fetches.get(image_url)
+            entry = future.result() if future else image_fetcher.fetch(image_url, self.egress)
+        except Exception as error:
+            logger.error(f"下载图片失败: {str(error)}", "Server")
+            return None
+        content = entry["content"]
+        if self.spool and len(content) > CONFIG["SPOOL"]["THRESHOLD"]:
+            content = self.spool.add(content.encode('ascii'))
+        return f"data:{entry['mimeType']};base64,{content}"
+
+    def upload_base64_image(self, base64_data, url, model):
+        try:
+            if base64_data.startswith(('http://', 'https://')):
+                base64_data = self.fetch_remote_image(base64_data)
+                if not base64_data:
+                    return ''
+            spooled = self.spool.get(base64_data) if self.spool else None
+            if spooled:
+                image_buffer = None
+            elif 'data:image' in base64_data:
                 image_buffer = base64_data.split(',')[1]
             else:
                 image_buffer = base64_data
@@ -674,28 +2216,57 @@ class GrokApiClient:
             mime_type = image_info["mimeType"]
             file_name = image_info["fileName"]
 
-            upload_data = {
-                "rpc": "uploadFile",
-                "req": {
-                    "fileName": file_name,
-                    "fileMimeType": mime_type,
-                    "content": image_buffer
-                }
+            token = self.token
+            cache_key = None
+            if CONFIG["UPLOAD_CACHE"]["ENABLED"]:
+                cache_key = UploadCache.get_key(token, mime_type, image_buffer, spooled["digest"] if spooled else None)
+                file_id = upload_cache.get(cache_key)
+                if file_id:
+                    logger.info(f"命中上传缓存，跳过图片上传: {file_id}", "Server")
+                    return file_id
+
+            if CONFIG["IMAGE"]["COMPRESS"]:
+                if spooled:
+                    with open(spooled["path"], 'rb') as f:
+                        compressed = ImageCompressor.compress(f.read(), mime_type)
+                else:
+                    compressed = ImageCompressor.compress(image_buffer, mime_type)
+                if compressed:
+                    image_buffer, mime_type = compressed
+                    file_name = f"image.{mime_type.split('/')[1]}"
+                    spooled = None
+
+            headers = {
+                **DEFAULT_HEADERS,
+                "Cookie":Utils.create_cookie(token, self.egress)
             }
+            if spooled:
+                # 大图片从临时文件分块写入上传请求体，不在内存中拼接完整JSON
+                prefix = ('{"rpc":"uploadFile","req":{"fileName":%s,"fileMimeType":%s,"content":"' % (json.dumps(file_name), json.dumps(mime_type))).encode('utf-8')
+                suffix = b'"}}'
+                headers["Content-Length"] = str(len(prefix) + spooled["size"] + len(suffix))
+                body_options = {"content": ImageSpool.iter_file(spooled["path"], prefix, suffix)}
+            else:
+                body_options = {"json": {
+                    "rpc": "uploadFile",
+                    "req": {
+                        "fileName": file_name,
+                        "fileMimeType": mime_type,
+                        "content": image_buffer
+                    }
+                }}
 
             logger.info("发送图片请求", "Server")
 
-            proxy_options = Utils.get_proxy_options()
+            proxy_options = Utils.get_proxy_options(self.egress)
             response = curl_requests.post(
                 url,
-                headers={
-                    **DEFAULT_HEADERS,
-                    "Cookie":CONFIG["SERVER"]['COOKIE']
-                },
-                json=upload_data,
+                headers=headers,
                 impersonate="chrome133a",
+                **body_options,
                 **proxy_options
             )
+            Utils.store_cookies(token, self.egress, response)
 
             if response.status_code != 200:
                 logger.error(f"上传图片失败,状态码:{response.status_code}", "Server")
@@ -703,6 +2274,8 @@ class GrokApiClient:
 
             result = response.json()
             logger.info(f"上传图片成功: {result}", "Server")
+            if cache_key:
+                upload_cache.put(cache_key, result.get("fileMetadataId", ""))
             return result.get("fileMetadataId", "")
 
         except Exception as error:
@@ -728,109 +2301,122 @@ class GrokApiClient:
     #     except Exception as error:
     #         logger.error(str(error), "Server")
     #         raise ValueError(error)
-    def prepare_chat_request(self, request):
-        if ((request["model"] == 'grok-4-imageGen' or request["model"] == 'grok-3-imageGen') and
-            not CONFIG["API"]["PICGO_KEY"] and not CONFIG["API"]["TUMY_KEY"] and
-            request.get("stream", False)):
-            raise ValueError("该模型流式输出需要配置PICGO或者TUMY图床密钥!")
+    def build_turns(self, request):
+        """按消息计算(角色, 规范化文本)，作为续聊缓存的键"""
+        self.turns = [
+            [current["role"], self.process_content(current.get("content", ""))]
+            for current in request["messages"]
+        ]
+        return self.turns
+
+    def estimate_prompt_tokens(self, request):
+        """按扁平化后的消息文本估算输入token数，单消息模型只计最后一条"""
+        turns = self.turns if self.turns is not None else self.build_turns(request)
+        if request["model"] in ['grok-4-imageGen', 'grok-3-imageGen', 'grok-3-deepsearch']:
+            turns = turns[-1:]
+        return sum(ContextPacker.estimate_tokens(text) for _, text in turns)
+
+    def get_image_urls(self, content):
+        if isinstance(content, list):
+            return [item["image_url"]["url"] for item in content if item["type"] == 'image_url']
+        if isinstance(content, dict) and content.get("type") == 'image_url':
+            return [content["image_url"]["url"]]
+        return []
+
+    def prepare_continuation(self, request):
+        """命中续聊缓存时只把新增消息发送到原会话，未命中返回None"""
+        if not CONFIG["CONVERSATION"]["CONTINUATION"] or request["model"] in ['grok-4-imageGen', 'grok-3-imageGen', 'grok-3-deepsearch']:
+            return None
+
+        turns = self.turns if self.turns is not None else self.build_turns(request)
+        todo_messages = request["messages"]
+        assistant_index = next((i for i in range(len(todo_messages) - 1, -1, -1) if todo_messages[i]["role"] == 'assistant'), None)
+        if assistant_index is None or assistant_index == len(todo_messages) - 1:
+            return None
+        tail = todo_messages[assistant_index + 1:]
+        if any(self.get_image_urls(current.get("content")) for current in tail):
+            return None
+
+        entry = conversation_cache.get(self.model_id, turns[:assistant_index + 1])
+        if not entry:
+            return None
 
+        if len(tail) == 1 and tail[0]["role"] == 'user':
+            message = turns[-1][1]
+        else:
+            message = '\n'.join(f"{('assistant' if role == 'assistant' else 'user').upper()}: {text}" for role, text in turns[assistant_index + 1:] if text)
+        if not message.strip():
+            return None
+
+        payload = self.build_request_payload(request, message.strip(), [])
+        del payload["temporary"]
+        payload["parentResponseId"] = entry["responseId"]
+        logger.info(f"命中续聊缓存，续接会话: {entry['conversationId']}", "Conversation")
+        return {**entry, "payload": payload}
+
+    def prepare_chat_request(self, request):
         # system_message, todo_messages = self.convert_system_messages(request["messages"]).values()
         todo_messages = request["messages"]
         if request["model"] in ['grok-4-imageGen', 'grok-3-imageGen', 'grok-3-deepsearch']:
-            last_message = todo_messages[-1]
-            if last_message["role"] != 'user':
-                raise ValueError('此模型最后一条消息必须是用户消息!')
-            todo_messages = [last_message]
+            todo_messages = [todo_messages[-1]]
         file_attachments = []
-        messages = ''
-        last_role = None
-        last_content = ''
-        message_length = 0
-        convert_to_file = False
-        last_message_content = ''
-        search = request["model"] in ['grok-4-deepsearch', 'grok-3-search']
-        deepsearchPreset = ''
-        if request["model"] == 'grok-3-deepsearch':
-            deepsearchPreset = 'default'
-        elif request["model"] == 'grok-3-deepersearch':
-            deepsearchPreset = 'deeper'
+        # 最后一条消息的图片在遍历历史消息的同时并发上传，按原顺序收集结果
+        image_uploads = [
+            upload_executor.submit(self.upload_base64_image, image_url, f"{CONFIG['API']['BASE_URL']}/api/rpc", request["model"])
+            for image_url in self.get_image_urls(todo_messages[-1].get("content"))[:4]
+        ]
+        # 单次遍历：每条消息一段(角色, 文本, 是否可与前一段合并)，由ContextPacker决定内联或溢出后一次性拼接
+        segments = []
+        turns = self.turns if todo_messages is request["messages"] else None
+        last_index = len(todo_messages) - 1
 
-        # 移除<think>标签及其内容和base64图片
-        def remove_think_tags(text):
-            import re
-            text = re.sub(r'<think>[\s\S]*?<\/think>', '', text).strip()
-            text = re.sub(r'!\[image\]\(data:.*?base64,.*?\)', '[图片]', text)
-            return text
-
-        def process_content(content):
-            if isinstance(content, list):
-                text_content = ''
-                for item in content:
-                    if item["type"] == 'image_url':
-                        text_content += ("[图片]" if not text_content else '\n[图片]')
-                    elif item["type"] == 'text':
-                        text_content += (remove_think_tags(item["text"]) if not text_content else '\n' + remove_think_tags(item["text"]))
-                return text_content
-            elif isinstance(content, dict) and content is not None:
-                if content["type"] == 'image_url':
-                    return "[图片]"
-                elif content["type"] == 'text':
-                    return remove_think_tags(content["text"])
-            return remove_think_tags(self.process_message_content(content))
-        for current in todo_messages:
+        for index, current in enumerate(todo_messages):
             role = 'assistant' if current["role"] == 'assistant' else 'user'
-            is_last_message = current == todo_messages[-1]
-
-            if is_last_message and "content" in current:
-                if isinstance(current["content"], list):
-                    for item in current["content"]:
-                        if item["type"] == 'image_url':
-                            processed_image = self.upload_base64_image(
-                                item["image_url"]["url"],
-                                f"{CONFIG['API']['BASE_URL']}/api/rpc"
-                            )
-                            if processed_image:
-                                file_attachments.append(processed_image)
-                elif isinstance(current["content"], dict) and current["content"].get("type") == 'image_url':
-                    processed_image = self.upload_base64_image(
-                        current["content"]["image_url"]["url"],
-                        f"{CONFIG['API']['BASE_URL']}/api/rpc"
-                    )
-                    if processed_image:
-                        file_attachments.append(processed_image)
-
+            is_last_message = index == last_index
 
-            text_content = process_content(current.get("content", ""))
-            if is_last_message and convert_to_file:
-                last_message_content = f"{role.upper()}: {text_content or '[图片]'}\n"
-                continue
+            text_content = turns[index][1] if turns is not None else self.process_content(current.get("content", ""))
+            if is_last_message and not text_content and image_uploads:
+                file_attachments.extend(file_id for file_id in (future.result() for future in image_uploads) if file_id)
+                image_uploads = []
             if text_content or (is_last_message and file_attachments):
-                if role == last_role and text_content:
-                    last_content += '\n' + text_content
-                    messages = messages[:messages.rindex(f"{role.upper()}: ")] + f"{role.upper()}: {last_content}\n"
-                else:
-                    messages += f"{role.upper()}: {text_content or '[图片]'}\n"
-                    last_content = text_content
-                    last_role = role
-            message_length += len(messages)
-            if message_length >= 40000:
-                convert_to_file = True
-               
-        if convert_to_file:
-            file_id = self.upload_base64_file(messages, request["model"])
+                segments.append((role, text_content or '[图片]', bool(text_content)))
+
+        # 超出内联预算时，最旧的历史写入message.txt上传，最近的几轮保留在消息中
+        spilled_segments, inline_segments, trimmed = ContextPacker.pack(segments)
+        if trimmed:
+            logger.info(f"上下文超出上限，已裁剪最早的{trimmed}段消息", "Server")
+        messages = ContextPacker.render(inline_segments)
+
+        # 历史文件与图片并发上传
+        file_upload = None
+        if spilled_segments:
+            logger.info(f"上下文转为文件: {len(spilled_segments)}段溢出，{len(inline_segments)}段内联", "Server")
+            file_upload = upload_executor.submit(self.upload_base64_file, ContextPacker.render(spilled_segments), request["model"])
+        file_attachments.extend(file_id for file_id in (future.result() for future in image_uploads) if file_id)
+        if file_upload:
+            file_id = file_upload.result()
             if file_id:
                 file_attachments.insert(0, file_id)
-            messages = last_message_content.strip()
         if messages.strip() == '':
-            if convert_to_file:
+            if file_upload:
                 messages = '基于txt文件内容进行回复：'
             else:
                 raise ValueError('消息内容为空!')
+        return self.build_request_payload(request, messages.strip(), file_attachments[:4])
+
+    def build_request_payload(self, request, message, file_attachments):
+        search = request["model"] in ['grok-4-deepsearch', 'grok-3-search']
+        deepsearchPreset = ''
+        if request["model"] == 'grok-3-deepsearch':
+            deepsearchPreset = 'default'
+        elif request["model"] == 'grok-3-deepersearch':
+            deepsearchPreset = 'deeper'
+
         return {
             "temporary": CONFIG["API"].get("IS_TEMP_CONVERSATION", False),
             "modelName": self.model_id,
-            "message": messages.strip(),
-            "fileAttachments": file_attachments[:4],
+            "message": message,
+            "fileAttachments": file_attachments,
             "imageAttachments": [],
             "disableSearch": False,
             "enableImageGeneration": True,
@@ -857,7 +2443,7 @@ class GrokApiClient:
 
 class MessageProcessor:
     @staticmethod
-    def create_chat_response(message, model, is_stream=False):
+    def create_chat_response(message, model, is_stream=False, usage=None):
         base_response = {
             "id": f"chatcmpl-{uuid.uuid4()}",
             "created": int(time.time()),
@@ -887,101 +2473,487 @@ class MessageProcessor:
                 },
                 "finish_reason": "stop"
             }],
-            "usage": None
+            "usage": usage
+        }
+
+class StreamChunkEncoder:
+    """每个流只生成一次SSE外层(固定id和created)，每个token只做JSON字符串转义"""
+    DONE = b"data: [DONE]\n\n"
+
+    CONTENT_PLACEHOLDER = "\u0000"
+
+    def __init__(self, model, include_usage=False):
+        self.base_chunk = {
+            "id": f"chatcmpl-{uuid.uuid4()}",
+            "created": int(time.time()),
+            "model": model,
+            "object": "chat.completion.chunk"
         }
+        chunk = {
+            **self.base_chunk,
+            "choices": [{
+                "index": 0,
+                "delta": {
+                    "content": self.CONTENT_PLACEHOLDER
+                }
+            }]
+        }
+        if include_usage:
+            # stream_options.include_usage时，除最后的用量块外每块usage都为null
+            chunk["usage"] = None
+        prefix, suffix = json.dumps(chunk).split(json.dumps(self.CONTENT_PLACEHOLDER), 1)
+        self.prefix = f"data: {prefix}".encode('utf-8')
+        self.suffix = f"{suffix}\n\n".encode('utf-8')
+
+    def encode(self, content):
+        return self.prefix + json.dumps(content).encode('ascii') + self.suffix
+
+    def encode_usage(self, usage):
+        return self.encode_event({**self.base_chunk, "choices": [], "usage": usage})
+
+    @staticmethod
+    def encode_event(data):
+        return f"data: {json.dumps(data)}\n\n".encode('utf-8')
+
+class ChunkCoalescer:
+    """把时间窗口内或未达到字节上限的多个token合并成一个SSE事件；窗口为0时逐token输出"""
+    __slots__ = ("encoder", "window", "max_bytes", "parts", "size", "flush_at")
+
+    def __init__(self, encoder, window_ms, max_bytes):
+        self.encoder = encoder
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+        self.parts = []
+        self.size = 0
+        self.flush_at = 0
+
+    def add(self, token):
+        if not self.window:
+            return self.encoder.encode(token)
+        if not self.parts:
+            self.flush_at = time.time() + self.window
+        self.parts.append(token)
+        self.size += len(token.encode('utf-8'))
+        if self.size >= self.max_bytes or time.time() >= self.flush_at:
+            return self.flush()
+        return None
+
+    def poll(self):
+        if self.parts and time.time() >= self.flush_at:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self.parts:
+            return None
+        data = self.encoder.encode(''.join(self.parts))
+        self.parts = []
+        self.size = 0
+        return data
+
+class UpstreamTimeout(Exception):
+    pass
+
+class UpstreamAttempt:
+    """一次上游会话请求：在独立线程中建立连接并持续读取NDJSON帧，首帧到达即就绪"""
+    def __init__(self, model, token, egress, payload, ready_queue=None, conversation_id=None):
+        self.model = model
+        self.token = token
+        self.egress = egress
+        self.payload = payload
+        self.conversation_id = conversation_id
+        self.is_continuation = conversation_id is not None
+        self.response_id = None
+        self.client = None
+        self.turns = None
+        self.ready_queue = ready_queue if ready_queue is not None else queue.Queue()
+        self.timeouts = Utils.get_upstream_timeouts(model)
+        self.response = None
+        self.line_queue = queue.Queue()
+        self.error = None
+        self.ttft = None
+        self.cancelled = False
+        # 上游返回了错误帧，结果仍按原格式返回客户端，但不能当作正常回复缓存
+        self.upstream_error = False
+
+    @property
+    def status_code(self):
+        return self.response.status_code if self.response is not None else None
+
+    def succeeded(self):
+        return self.error is None and self.status_code == 200
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def wait(self):
+        """启动并等待首帧，超过首字节超时则放弃该连接"""
+        self.start()
+        try:
+            return self.ready_queue.get(timeout=self.timeouts["first_byte"])
+        except queue.Empty:
+            self.fail(UpstreamTimeout(f"首字节超时({self.timeouts['first_byte']}秒)"))
+            return self
+
+    def fail(self, error):
+        self.error = error
+        self.close()
+
+    def run(self):
+        start_time = time.time()
+        is_ready = False
+        try:
+            proxy_options = Utils.get_proxy_options(self.egress)
+            if self.is_continuation:
+                url = f"{CONFIG['API']['BASE_URL']}/rest/app-chat/conversations/{self.conversation_id}/responses"
+            else:
+                url = f"{CONFIG['API']['BASE_URL']}/rest/app-chat/conversations/new"
+            self.response = curl_requests.post(
+                url,
+                headers={**DEFAULT_HEADERS, "Cookie": Utils.create_cookie(self.token, self.egress)},
+                data=json.dumps(self.payload),
+                impersonate="chrome133a",
+                stream=True,
+                timeout=(self.timeouts["connect"], max(self.timeouts["first_byte"], self.timeouts["idle"])),
+                **proxy_options
+            )
+            Utils.store_cookies(self.token, self.egress, self.response)
+
+            if self.response.status_code == 200 and not self.cancelled:
+                for line in self.response.iter_lines():
+                    if self.cancelled:
+                        break
+                    if not line:
+                        continue
+                    self.line_queue.put(line)
+                    if not is_ready:
+                        is_ready = True
+                        self.ttft = time.time() - start_time
+                        request_hedger.record_ttft(self.model, self.is_continuation, self.ttft)
+                        self.ready_queue.put(self)
+        except Exception as error:
+            if not is_ready:
+                self.error = error
+            else:
+                self.line_queue.put(error)
+
+        self.line_queue.put(None)
+        if self.cancelled:
+            self.close()
+        if not is_ready:
+            self.ready_queue.put(self)
+
+    def extract_response(self, line_json):
+        """取出帧中的response并记录会话ID和回复ID；续聊接口的帧不带response外层"""
+        result = line_json.get("result", {})
+        if result.get("conversation"):
+            self.conversation_id = result["conversation"].get("conversationId", self.conversation_id)
+
+        response_data = result.get("response")
+        if response_data is None and self.is_continuation and ("token" in result or "modelResponse" in result):
+            response_data = result
+        if response_data:
+            model_response = response_data.get("modelResponse") or {}
+            self.response_id = model_response.get("responseId") or response_data.get("responseId") or self.response_id
+        return response_data
+
+    def iter_lines(self, tick=None):
+        """tick不为空时，每隔tick秒没有新帧就产出一个空帧，供调用方做定时刷新"""
+        idle_timeout = self.timeouts["idle"]
+        last_line_time = time.time()
+        while True:
+            try:
+                if tick:
+                    remaining = idle_timeout - (time.time() - last_line_time)
+                    line = self.line_queue.get(timeout=max(0, min(remaining, tick)))
+                else:
+                    line = self.line_queue.get(timeout=idle_timeout)
+            except queue.Empty:
+                if tick and time.time() - last_line_time < idle_timeout:
+                    yield b''
+                    continue
+                self.close()
+                raise UpstreamTimeout(f"上游流空闲超过{idle_timeout}秒")
+            last_line_time = time.time()
+            if line is None:
+                return
+            if isinstance(line, Exception):
+                raise line
+            yield line
+
+    def close(self):
+        self.cancelled = True
+        try:
+            if self.response is not None:
+                self.response.close()
+        except Exception:
+            pass
+
+class RequestHedger:
+    """首帧迟迟未到时，换账号和出口发起第二个请求，先返回首帧者胜出"""
+    def __init__(self):
+        # (模型, 是否续聊) -> 最近的首帧耗时；深度搜索等模型的首帧耗时相差数十倍，不能混在一起算分位数
+        self.ttft_samples = {}
+        self.credits = 0.0
+        self.lock = threading.Lock()
+
+    def record_ttft(self, model, is_continuation, seconds):
+        with self.lock:
+            samples = self.ttft_samples.get((model, is_continuation))
+            if samples is None:
+                samples = self.ttft_samples[(model, is_continuation)] = deque(maxlen=200)
+            samples.append(seconds)
+
+    def get_hedge_delay(self, model, is_continuation=False):
+        config = CONFIG["HEDGE"]
+        with self.lock:
+            samples = sorted(self.ttft_samples.get((model, is_continuation), ()))
+        if len(samples) < config["MIN_SAMPLES"]:
+            return config["DEFAULT_DELAY"]
+        index = max(0, math.ceil(config["PERCENTILE"] / 100 * len(samples)) - 1)
+        return max(samples[index], config["MIN_DELAY"])
+
+    def acquire_credit(self):
+        """对冲额度按主请求数的HEDGE_RATIO累积，保证对冲不会让配额消耗翻倍"""
+        with self.lock:
+            if self.credits < 1:
+                return False
+            self.credits -= 1
+            return True
+
+    def add_primary(self):
+        with self.lock:
+            self.credits = min(self.credits + CONFIG["HEDGE"]["RATIO"], CONFIG["HEDGE"]["BURST"])
+
+    def start_hedge(self, primary, ready_queue):
+        if CONFIG["API"]["IS_CUSTOM_SSO"] or primary.payload.get("fileAttachments"):
+            return None
+        if not self.acquire_credit():
+            return None
+
+        token = token_manager.get_alternate_token_for_model(
+            primary.model, (primary.token,), CONFIG["HEDGE"]["MIN_REMAINING"]
+        )
+        if not token:
+            with self.lock:
+                self.credits += 1
+            return None
+
+        egress = cf_pool.get_egress(exclude=(cf_pool.get_proxy_key(primary.egress["proxy"]),))
+        logger.info(f"首帧超时，发起对冲请求: {token[:50]}...", "Hedge")
+        hedge = UpstreamAttempt(primary.model, token, egress, primary.payload, ready_queue)
+        hedge.client = primary.client
+        hedge.turns = primary.turns
+        return hedge.start()
+
+    def execute(self, primary):
+        self.add_primary()
+        ready_queue = primary.ready_queue
+        first_byte_timeout = primary.timeouts["first_byte"]
+        deadline = time.time() + first_byte_timeout
+        primary.start()
+
+        try:
+            return ready_queue.get(timeout=min(self.get_hedge_delay(primary.model, primary.is_continuation), first_byte_timeout))
+        except queue.Empty:
+            pass
+
+        # 尚未返回首帧的请求 -> 各自的截止时间；对冲请求有完整的首字节时限，主请求仍按原时限
+        pending = {primary: deadline}
+        hedge = self.start_hedge(primary, ready_queue)
+        if hedge:
+            pending[hedge] = time.time() + first_byte_timeout
+
+        winner = None
+        while pending:
+            try:
+                attempt = ready_queue.get(timeout=max(0, min(pending.values()) - time.time()))
+            except queue.Empty:
+                now = time.time()
+                for attempt in [item for item, item_deadline in pending.items() if item_deadline <= now]:
+                    del pending[attempt]
+                    attempt.fail(UpstreamTimeout(f"首字节超时({first_byte_timeout}秒)"))
+                    if not pending:
+                        # 最后一个失败的请求交给调用方处理
+                        return attempt
+                    handle_attempt_failure(attempt)
+                continue
+            if attempt not in pending:
+                continue
+            del pending[attempt]
+            if attempt.succeeded() or not pending:
+                winner = attempt
+                break
+            handle_attempt_failure(attempt)
+
+        for attempt in pending:
+            attempt.close()
+        if hedge and winner.succeeded():
+            logger.info(f"对冲完成，胜出令牌: {winner.token[:50]}...", "Hedge")
+        return winner
+
+def handle_attempt_failure(attempt):
+    if isinstance(attempt.error, UpstreamTimeout):
+        # 超时多为上游一时变慢，切换账号重试，原账号只短暂停用
+        logger.warning(f"请求超时: {str(attempt.error)}，切换令牌", "Server")
+        if not CONFIG["API"]["IS_CUSTOM_SSO"]:
+            token_manager.cool_down_token(attempt.model, attempt.token, str(attempt.error))
+        return
+
+    if attempt.error is not None:
+        logger.error(f"请求处理时发生异常: {str(attempt.error)}，标记token为无效", "Server")
+        if not CONFIG["API"]["IS_CUSTOM_SSO"]:
+            token_manager.mark_token_invalid(attempt.model, attempt.token, f"异常: {str(attempt.error)}")
+        return
+
+    if Utils.is_cf_challenge(attempt.response):
+        # cf盾针对的是出口而不是账号：记在出口上，账号只短暂停用以便本次请求换号换出口重试
+        logger.warning(f"出口 {cf_pool.get_proxy_key(attempt.egress['proxy'])} 触发cf盾", "Server")
+        cf_pool.record_challenge(attempt.egress["proxy"])
+        if not CONFIG["API"]["IS_CUSTOM_SSO"]:
+            token_manager.cool_down_token(attempt.model, attempt.token, "cf盾")
+        return
+
+    # 任何非200状态码都标记token为无效（悲观策略）
+    logger.warning(f"令牌请求失败，状态码: {attempt.status_code}，标记token为无效", "Server")
+    if not CONFIG["API"]["IS_CUSTOM_SSO"]:
+        token_manager.mark_token_invalid(attempt.model, attempt.token, f"HTTP {attempt.status_code}")
+
+class StreamParser:
+    """单个上游响应的解析状态。按模型从HANDLERS中选一次处理函数，状态随请求创建，并发流互不影响"""
+    __slots__ = ("handler", "skip_rules", "is_thinking", "is_img_gen", "is_img_gen2")
+    # 带有这些字段的帧可能影响会话记录、生图或报错，预筛时一律保留；responseId每帧都带，续聊只需要最后的modelResponse帧
+    KEEP_MARKERS = (b'"error"', b'"conversation"', b'modelResponse', b'doImgGen', b'imageAttachmentInfo', b'cachedImageGenerationResponse')
+
+    def __init__(self, model):
+        self.handler = self.HANDLERS.get(model, StreamParser.parse_none)
+        self.skip_rules = self.get_skip_rules(model)
+        self.is_thinking = False
+        self.is_img_gen = False
+        self.is_img_gen2 = False
+
+    @staticmethod
+    def get_skip_rules(model):
+        """返回(字节标记, 帧内token是否也会被丢弃)：命中的帧处理结果必为空，可不做JSON解析"""
+        rules = []
+        if model == 'grok-4' or (model in ['grok-3-reasoning', 'grok-4-reasoning'] and not CONFIG["SHOW_THINKING"]):
+            rules.append((b'"isThinking":true', True))
+        if model == 'grok-3-search' and not CONFIG["ISSHOW_SEARCH_RESULTS"]:
+            rules.append((b'"webSearchResults"', False))
+        return tuple(rules)
+
+    def should_skip(self, line):
+        """字节级预筛，line为上游原始帧"""
+        for marker, drops_token in self.skip_rules:
+            if marker in line and (drops_token or b'"token":' not in line or b'"token":""' in line):
+                return not any(keep in line for keep in self.KEEP_MARKERS)
+        return False
+
+    def feed(self, response):
+        """处理一帧，返回(token, imageUrl)"""
+        if response.get("doImgGen") or response.get("imageAttachmentInfo"):
+            self.is_img_gen = True
+        if self.is_img_gen:
+            if response.get("cachedImageGenerationResponse") and not self.is_img_gen2:
+                self.is_img_gen2 = True
+                return None, response["cachedImageGenerationResponse"]["imageUrl"]
+            return None, None
+        return self.handler(self, response), None
+
+    def parse_none(self, response):
+        return None
 
-def process_model_response(response, model):
-    result = {"token": None, "imageUrl": None}
+    def parse_plain(self, response):
+        return response.get("token")
 
-    if CONFIG["IS_IMG_GEN"]:
-        if response.get("cachedImageGenerationResponse") and not CONFIG["IS_IMG_GEN2"]:
-            result["imageUrl"] = response["cachedImageGenerationResponse"]["imageUrl"]
-        return result
-    if model == 'grok-3':
-        result["token"] = response.get("token")
-    elif model in ['grok-3-search']:
+    def parse_search(self, response):
         if response.get("webSearchResults") and CONFIG["ISSHOW_SEARCH_RESULTS"]:
-            result["token"] = f"\r\n<think>{Utils.organize_search_results(response['webSearchResults'])}</think>\r\n"
-        else:
-            result["token"] = response.get("token")
-    elif model in ['grok-3-deepsearch', 'grok-3-deepersearch','grok-4-deepsearch']:
-        if response.get("messageStepId") and not CONFIG["SHOW_THINKING"]:
-            return result
-        if response.get("messageStepId") and not CONFIG["IS_THINKING"]:
-            result["token"] = "<think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = True
-        elif not response.get("messageStepId") and CONFIG["IS_THINKING"] and response.get("messageTag") == "final":
-            result["token"] = "</think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = False
-        elif (response.get("messageStepId") and CONFIG["IS_THINKING"] and response.get("messageTag") == "assistant") or response.get("messageTag") == "final":
-            result["token"] = response.get("token","")
-        elif (CONFIG["IS_THINKING"] and response.get("token","").get("action","") == "webSearch"):
-            result["token"] = response.get("token","").get("action_input","").get("query","")            
-        elif (CONFIG["IS_THINKING"] and response.get("webSearchResults")):
-            result["token"] = Utils.organize_search_results(response['webSearchResults'])
-    elif model == 'grok-3-reasoning':
-        if response.get("isThinking") and not CONFIG["SHOW_THINKING"]:
-            return result
-
-        if response.get("isThinking") and not CONFIG["IS_THINKING"]:
-            result["token"] = "<think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = True
-        elif not response.get("isThinking") and CONFIG["IS_THINKING"]:
-            result["token"] = "</think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = False
-        else:
-            result["token"] = response.get("token")
+            return f"\r\n<think>{Utils.organize_search_results(response['webSearchResults'])}</think>\r\n"
+        return response.get("token")
+
+    def parse_deepsearch(self, response):
+        step_id = response.get("messageStepId")
+        if step_id and not CONFIG["SHOW_THINKING"]:
+            return None
+        message_tag = response.get("messageTag")
+        if step_id and not self.is_thinking:
+            self.is_thinking = True
+            return "<think>" + response.get("token", "")
+        if not step_id and self.is_thinking and message_tag == "final":
+            self.is_thinking = False
+            return "</think>" + response.get("token", "")
+        if (step_id and self.is_thinking and message_tag == "assistant") or message_tag == "final":
+            return response.get("token", "")
+        if self.is_thinking:
+            token = response.get("token")
+            if isinstance(token, dict) and token.get("action") == "webSearch":
+                return token.get("action_input", {}).get("query", "")
+            if response.get("webSearchResults"):
+                return Utils.organize_search_results(response['webSearchResults'])
+        return None
 
-    elif model == 'grok-4':
+    def parse_reasoning(self, response):
+        is_thinking = response.get("isThinking")
+        if is_thinking and not CONFIG["SHOW_THINKING"]:
+            return None
+        if is_thinking and not self.is_thinking:
+            self.is_thinking = True
+            return "<think>" + response.get("token", "")
+        if not is_thinking and self.is_thinking:
+            self.is_thinking = False
+            return "</think>" + response.get("token", "")
+        return response.get("token")
+
+    def parse_grok4(self, response):
         if response.get("isThinking"):
-            return result
-        result["token"] = response.get("token")
-    elif model == 'grok-4-reasoning':
-        if response.get("isThinking") and not CONFIG["SHOW_THINKING"]:
-            return result
-        if response.get("isThinking") and not CONFIG["IS_THINKING"] and response.get("messageTag") == "assistant":
-            result["token"] = "<think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = True
-        elif not response.get("isThinking") and CONFIG["IS_THINKING"] and response.get("messageTag") == "final":
-            result["token"] = "</think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = False
-        else:
-            result["token"] = response.get("token")  
-    elif model in ['grok-4-deepsearch']:
-        if response.get("messageStepId") and not CONFIG["SHOW_THINKING"]:
-            return result
-        if response.get("messageStepId") and not CONFIG["IS_THINKING"] and response.get("messageTag") == "assistant":
-            result["token"] = "<think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = True
-        elif not response.get("messageStepId") and CONFIG["IS_THINKING"] and response.get("messageTag") == "final":
-            result["token"] = "</think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = False
-        elif (response.get("messageStepId") and CONFIG["IS_THINKING"] and response.get("messageTag") == "assistant") or response.get("messageTag") == "final":
-            result["token"] = response.get("token","")
-        elif (CONFIG["IS_THINKING"] and response.get("token","").get("action","") == "webSearch"):
-            result["token"] = response.get("token","").get("action_input","").get("query","")            
-        elif (CONFIG["IS_THINKING"] and response.get("webSearchResults")):
-            result["token"] = Utils.organize_search_results(response['webSearchResults'])      
-
-    return result
-
-def handle_image_response(image_url):
+            return None
+        return response.get("token")
+
+    def parse_grok4_reasoning(self, response):
+        is_thinking = response.get("isThinking")
+        if is_thinking and not CONFIG["SHOW_THINKING"]:
+            return None
+        message_tag = response.get("messageTag")
+        if is_thinking and not self.is_thinking and message_tag == "assistant":
+            self.is_thinking = True
+            return "<think>" + response.get("token", "")
+        if not is_thinking and self.is_thinking and message_tag == "final":
+            self.is_thinking = False
+            return "</think>" + response.get("token", "")
+        return response.get("token")
+
+    HANDLERS = {
+        "grok-3": parse_plain,
+        "grok-3-search": parse_search,
+        "grok-3-deepsearch": parse_deepsearch,
+        "grok-3-deepersearch": parse_deepsearch,
+        "grok-4-deepsearch": parse_deepsearch,
+        "grok-3-reasoning": parse_reasoning,
+        "grok-4": parse_grok4,
+        "grok-4-reasoning": parse_grok4_reasoning
+    }
+
+def handle_image_response(image_url, token, egress=None):
     max_retries = 2
     retry_count = 0
     image_base64_response = None
 
     while retry_count < max_retries:
         try:
-            proxy_options = Utils.get_proxy_options()
+            proxy_options = Utils.get_proxy_options(egress)
             image_base64_response = curl_requests.get(
                 f"https://assets.grok.com/{image_url}",
                 headers={
                     **DEFAULT_HEADERS,
-                    "Cookie":CONFIG["SERVER"]['COOKIE']
+                    "Cookie":Utils.create_cookie(token, egress)
                 },
                 impersonate="chrome133a",
                 **proxy_options
             )
+            Utils.store_cookies(token, egress, image_base64_response)
 
             if image_base64_response.status_code == 200:
                 break
@@ -1053,41 +3025,35 @@ def handle_image_response(image_url):
                 logger.error(str(error), "Server")
                 return "生图失败，请查看TUMY图床密钥是否设置正确"
 
-def handle_non_stream_response(response, model):
+def handle_non_stream_response(attempt, model):
     try:
         logger.info("开始处理非流式响应", "Server")
 
-        stream = response.iter_lines()
+        stream = attempt.iter_lines()
         full_response = ""
-
-        CONFIG["IS_THINKING"] = False
-        CONFIG["IS_IMG_GEN"] = False
-        CONFIG["IS_IMG_GEN2"] = False
+        parser = StreamParser(model)
 
         for chunk in stream:
-            if not chunk:
+            if not chunk or parser.should_skip(chunk):
                 continue
             try:
-                line_json = json.loads(chunk.decode("utf-8").strip())
+                line_json = Utils.decode_json(chunk)
                 if line_json.get("error"):
                     logger.error(json.dumps(line_json, indent=2), "Server")
+                    attempt.upstream_error = True
                     return json.dumps({"error": "RateLimitError"}) + "\n\n"
 
-                response_data = line_json.get("result", {}).get("response")
+                response_data = attempt.extract_response(line_json)
                 if not response_data:
                     continue
 
-                if response_data.get("doImgGen") or response_data.get("imageAttachmentInfo"):
-                    CONFIG["IS_IMG_GEN"] = True
-
-                result = process_model_response(response_data, model)
+                token, image_url = parser.feed(response_data)
 
-                if result["token"]:
-                    full_response += result["token"]
+                if token:
+                    full_response += token
 
-                if result["imageUrl"]:
-                    CONFIG["IS_IMG_GEN2"] = True
-                    return handle_image_response(result["imageUrl"])
+                if image_url:
+                    return handle_image_response(image_url, attempt.token, attempt.egress)
 
             except json.JSONDecodeError:
                 continue
@@ -1095,55 +3061,136 @@ def handle_non_stream_response(response, model):
                 logger.error(f"处理非流式响应行时出错: {str(e)}", "Server")
                 raise e
 
+        conversation_cache.remember(attempt, full_response)
         return full_response
     except Exception as error:
         logger.error(str(error), "Server")
         raise
-def handle_stream_response(response, model):
+def keep_alive(events, interval):
+    """过滤空检查点；距离上次输出超过interval秒时输出SSE注释心跳，避免负载均衡和客户端因空闲断开"""
+    last_write = time.time()
+    try:
+        for data in events:
+            now = time.time()
+            if data:
+                last_write = now
+                yield data
+            elif now - last_write >= interval:
+                last_write = now
+                yield b": keep-alive\n\n"
+    finally:
+        events.close()
+
+def handle_stream_response(attempt, model, reconnect=None, coalesce_ms=0, usage_context=None):
+    heartbeat = CONFIG["STREAM"]["HEARTBEAT"]
+    usage_context = usage_context or {}
+
     def generate():
         logger.info("开始处理流式响应", "Server")
 
-        stream = response.iter_lines()
-        CONFIG["IS_THINKING"] = False
-        CONFIG["IS_IMG_GEN"] = False
-        CONFIG["IS_IMG_GEN2"] = False
+        encoder = StreamChunkEncoder(model, usage_context.get("include", False))
+        coalescer = ChunkCoalescer(encoder, coalesce_ms, CONFIG["STREAM"]["COALESCE_BYTES"])
+        tick = min((interval for interval in (coalescer.window, heartbeat) if interval), default=None)
+        current_attempt = attempt
+        has_output = False
+        output_parts = []
+        usage_recorded = False
+
+        def record_usage():
+            # 只在流结束时调用一次；之后客户端再断开不算取消，也不重复计数
+            nonlocal usage_recorded
+            usage_recorded = True
+            usage = UsageTracker.build_usage(usage_context.get("prompt_tokens", 0), ContextPacker.estimate_tokens(''.join(output_parts)))
+            if current_attempt:
+                usage_tracker.record(usage_context.get("api_key"), current_attempt.token, model, usage)
+            return usage
 
-        for chunk in stream:
-            if not chunk:
-                continue
-            try:
-                line_json = json.loads(chunk.decode("utf-8").strip())
-                print(line_json)
-                if line_json.get("error"):
-                    logger.error(json.dumps(line_json, indent=2), "Server")
-                    yield json.dumps({"error": "RateLimitError"}) + "\n\n"
+        try:
+            while True:
+                stream = current_attempt.iter_lines(tick)
+                parser = StreamParser(model)
+
+                try:
+                    for chunk in stream:
+                        if heartbeat:
+                            # 空检查点，由keep_alive判断是否需要心跳
+                            yield b''
+                        if coalescer.parts:
+                            data = coalescer.poll()
+                            if data:
+                                yield data
+                        if not chunk or parser.should_skip(chunk):
+                            continue
+                        try:
+                            line_json = Utils.decode_json(chunk)
+                            if line_json.get("error"):
+                                logger.error(json.dumps(line_json, indent=2), "Server")
+                                data = coalescer.flush()
+                                if data:
+                                    yield data
+                                record_usage()
+                                yield (json.dumps({"error": "RateLimitError"}) + "\n\n").encode('utf-8')
+                                return
+
+                            response_data = current_attempt.extract_response(line_json)
+                            if not response_data:
+                                continue
+
+                            token, image_url = parser.feed(response_data)
+
+                            if token:
+                                has_output = True
+                                output_parts.append(token)
+                                data = coalescer.add(token)
+                                if data:
+                                    yield data
+
+                            if image_url:
+                                has_output = True
+                                data = coalescer.flush()
+                                if data:
+                                    yield data
+                                image_data = handle_image_response(image_url, current_attempt.token, current_attempt.egress)
+                                yield encoder.encode(image_data)
+
+                        except json.JSONDecodeError:
+                            continue
+                        except Exception as e:
+                            logger.error(f"处理流式响应行时出错: {str(e)}", "Server")
+                            raise e
+                    conversation_cache.remember(current_attempt, ''.join(output_parts))
+                    break
+                except UpstreamTimeout as error:
+                    logger.error(f"流式响应超时: {str(error)}", "Server")
+                    if not has_output and reconnect and not CONFIG["API"]["IS_CUSTOM_SSO"]:
+                        token_manager.cool_down_token(model, current_attempt.token, str(error))
+                        current_attempt = reconnect()
+                        if current_attempt:
+                            logger.info("尚未向客户端输出内容，已切换令牌重试", "Server")
+                            continue
+                    data = coalescer.flush()
+                    if data:
+                        yield data
+                    record_usage()
+                    error_body = {"error": {"message": f"上游响应超时: {str(error)}", "type": "timeout_error"}}
+                    yield StreamChunkEncoder.encode_event(error_body)
                     return
 
-                response_data = line_json.get("result", {}).get("response")
-                if not response_data:
-                    continue
-
-                if response_data.get("doImgGen") or response_data.get("imageAttachmentInfo"):
-                    CONFIG["IS_IMG_GEN"] = True
-
-                result = process_model_response(response_data, model)
-
-                if result["token"]:
-                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(result['token'], model, True))}\n\n"
-
-                if result["imageUrl"]:
-                    CONFIG["IS_IMG_GEN2"] = True
-                    image_data = handle_image_response(result["imageUrl"])
-                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(image_data, model, True))}\n\n"
-
-            except json.JSONDecodeError:
-                continue
-            except Exception as e:
-                logger.error(f"处理流式响应行时出错: {str(e)}", "Server")
-                raise e
-
-        yield "data: [DONE]\n\n"
-    return generate()
+            data = coalescer.flush()
+            if data:
+                yield data
+            usage = record_usage()
+            if usage_context.get("include"):
+                yield encoder.encode_usage(usage)
+            yield StreamChunkEncoder.DONE
+        except GeneratorExit:
+            # 客户端断开后WSGI服务器关闭生成器，立即关闭上游连接，释放读取线程和账号
+            if current_attempt and not usage_recorded:
+                current_attempt.close()
+                token_manager.record_cancellation(model, current_attempt.token)
+                record_usage()
+            raise
+    return keep_alive(generate(), heartbeat) if heartbeat else generate()
 
 def initialization():
     sso_array = os.environ.get("SSO", "").split(',')
@@ -1162,6 +3209,32 @@ def initialization():
         })
     
 
+    cf_pool.load_pool()
+    cookie_jar.load_jars()
+    upload_cache.load_cache()
+    usage_tracker.load_usage()
+    idempotency_store.sweep_disk()
+    response_cache.sweep_disk()
+    configured_proxies = [CONFIG["API"]["PROXY"]] if CONFIG["API"]["PROXY"] or CONFIG["SERVER"]["CF_CLEARANCE"] else []
+    if CONFIG["SERVER"]["CF_CLEARANCE"]:
+        cf_pool.seed_clearance(CONFIG["API"]["PROXY"], CONFIG["SERVER"]["CF_CLEARANCE"])
+    elif CONFIG["API"]["PROXY"]:
+        cf_pool.add_proxy(CONFIG["API"]["PROXY"])
+    for item in (CONFIG["SERVER"]["CF_CLEARANCE_POOL"] or "").split(','):
+        if not item.strip():
+            continue
+        proxy, _, cf_clearance = item.strip().partition('|')
+        proxy = CfClearancePool.normalize_proxy(proxy)
+        configured_proxies.append(proxy)
+        if cf_clearance:
+            cf_pool.seed_clearance(proxy, cf_clearance)
+        else:
+            cf_pool.add_proxy(proxy)
+    # 未配置任何出口时使用默认直连，保留通过接口为直连设置的cf_clearance
+    cf_pool.prune(configured_proxies or [None])
+    cf_pool.save_pool()
+    logger.info(f"cf_clearance池加载完成，共{len(cf_pool.get_pool_status())}个出口", "Server")
+
     logger.info("开始加载令牌", "Server")
     token_manager.load_token_status()
     for tokens in combined_dict:
@@ -1213,6 +3286,12 @@ def get_manager_tokens():
         return jsonify({"error": "Unauthorized"}), 401
     return jsonify(token_manager.get_token_status_map())
 
+@app.route('/manager/api/usage')
+def get_manager_usage():
+    if not check_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(usage_tracker.get_usage())
+
 @app.route('/manager/api/add', methods=['POST'])
 def add_manager_token():
     if not check_auth():
@@ -1247,7 +3326,7 @@ def setCf_Manager_clearance():
         cf_clearance = request.json.get('cf_clearance')
         if not cf_clearance:
             return jsonify({"error": "cf_clearance is required"}), 400
-        CONFIG["SERVER"]['CF_CLEARANCE'] = cf_clearance
+        cf_pool.set_clearance(request.json.get('proxy', CONFIG["API"]["PROXY"]), cf_clearance, request.json.get('ttl'))
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1262,6 +3341,15 @@ def get_tokens():
         return jsonify({"error": 'Unauthorized'}), 401
     return jsonify(token_manager.get_token_status_map())
 
+@app.route('/get/usage', methods=['GET'])
+def get_usage():
+    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if CONFIG["API"]["IS_CUSTOM_SSO"]:
+        return jsonify({"error": '自定义的SSO令牌模式无法获取用量统计'}), 403
+    elif auth_token != CONFIG["API"]["API_KEY"]:
+        return jsonify({"error": 'Unauthorized'}), 401
+    return jsonify(usage_tracker.get_usage())
+
 @app.route('/add/token', methods=['POST'])
 def add_token():
     auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
@@ -1285,11 +3373,37 @@ def setCf_clearance():
         return jsonify({"error": 'Unauthorized'}), 401
     try:
         cf_clearance = request.json.get('cf_clearance')
-        CONFIG["SERVER"]['CF_CLEARANCE'] = cf_clearance
+        if not cf_clearance:
+            return jsonify({"error": 'cf_clearance不能为空'}), 400
+        ttl = request.json.get('ttl')
+        if ttl is not None and (not isinstance(ttl, (int, float)) or isinstance(ttl, bool) or ttl <= 0):
+            return jsonify({"error": 'ttl必须是正数（小时）'}), 400
+        proxy = CfClearancePool.normalize_proxy(request.json['proxy']) if 'proxy' in request.json else CONFIG["API"]["PROXY"]
+        cf_pool.set_clearance(proxy, cf_clearance, ttl)
         return jsonify({"message": '设置cf_clearance成功'}), 200
     except Exception as error:
         logger.error(str(error), "Server")
         return jsonify({"error": '设置cf_clearance失败'}), 500
+
+@app.route('/get/cf_clearance', methods=['GET'])
+def get_cf_clearance():
+    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if auth_token != CONFIG["API"]["API_KEY"]:
+        return jsonify({"error": 'Unauthorized'}), 401
+    return jsonify(cf_pool.get_pool_status())
+
+@app.route('/delete/cf_clearance', methods=['POST'])
+def delete_cf_clearance():
+    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if auth_token != CONFIG["API"]["API_KEY"]:
+        return jsonify({"error": 'Unauthorized'}), 401
+    try:
+        if not cf_pool.remove_proxy(CfClearancePool.normalize_proxy(request.json.get('proxy'))):
+            return jsonify({"error": '未找到该出口'}), 404
+        return jsonify({"message": '删除cf_clearance成功'}), 200
+    except Exception as error:
+        logger.error(str(error), "Server")
+        return jsonify({"error": '删除cf_clearance失败'}), 500
     
 @app.route('/delete/token', methods=['POST'])
 def delete_token():
@@ -1322,8 +3436,86 @@ def get_models():
         ]
     })
 
+def open_continuation(model, grok_client):
+    continuation = grok_client.continuation
+    grok_client.continuation = None
+    token = token_manager.get_token_for_model(model, continuation["token"])
+    if not token:
+        logger.info("续聊会话所属账号不可用，改为完整请求", "Conversation")
+        return None
+
+    attempt = UpstreamAttempt(model, token, grok_client.egress, continuation["payload"], conversation_id=continuation["conversationId"])
+    attempt.client = grok_client
+    attempt.turns = grok_client.turns
+    attempt.wait()
+    if attempt.succeeded():
+        logger.info("续聊请求成功", "Conversation")
+        cf_pool.record_success(attempt.egress["proxy"])
+        return attempt
+
+    logger.warning(f"续聊请求失败，状态码: {attempt.status_code}，改为完整请求", "Conversation")
+    attempt.close()
+    conversation_cache.discard(continuation["key"])
+    return None
+
+def open_upstream(model, grok_client, request_data):
+    """轮询令牌直到上游返回首帧，全部失败时返回None"""
+    if grok_client.continuation:
+        attempt = open_continuation(model, grok_client)
+        if attempt:
+            return attempt
+
+    while token_manager.get_token_count_for_model(model) > 0:
+        current_token = Utils.create_auth_headers(model)
+        if not current_token:
+            logger.warning("轮询结束，未找到可用令牌。", "Server")
+            break
+
+        CONFIG["API"]["SIGNATURE_COOKIE"] = current_token
+        logger.info(f"正在尝试令牌: {json.dumps(current_token, indent=2)}", "Server")
+
+        # 上传与对话绑定同一账号：文件ID只对上传它的账号有效，换号后需用新账号重新准备。
+        # 上传在对话请求发出前完成：请求体里的fileAttachments要等上传返回文件ID，每次请求都新建连接，
+        # 没有可提前建立的连接；对冲请求也要复用完整的请求体。上传只与历史消息处理和其他上传并发
+        if (grok_client.request_payload is None or
+            (grok_client.request_payload["fileAttachments"] and grok_client.token != current_token)):
+            grok_client.token = current_token
+            try:
+                grok_client.request_payload = grok_client.prepare_chat_request(request_data)
+            except Exception as error:
+                # 请求没有发出，退回本次计数后把错误交给调用方
+                logger.error(f"准备请求失败: {str(error)}", "Server")
+                grok_client.request_payload = None
+                token_manager.refund_token(model, current_token)
+                raise
+            logger.info(json.dumps(grok_client.request_payload, indent=2))
+        grok_client.token = current_token
+
+        attempt = UpstreamAttempt(model, current_token, grok_client.egress, grok_client.request_payload)
+        attempt.client = grok_client
+        attempt.turns = grok_client.turns
+        if CONFIG["HEDGE"]["ENABLED"]:
+            attempt = request_hedger.execute(attempt)
+        else:
+            attempt.wait()
+
+        if attempt.succeeded():
+            logger.info("请求成功", "Server")
+            cf_pool.record_success(attempt.egress["proxy"])
+            return attempt
+
+        if CONFIG["API"]["IS_CUSTOM_SSO"]:
+            if attempt.error is not None:
+                raise attempt.error
+            raise ValueError(f"自定义SSO令牌当前模型{model}的请求次数已失效")
+        if attempt.response is not None and Utils.is_cf_challenge(attempt.response):
+            grok_client.egress = cf_pool.get_egress(exclude=(cf_pool.get_proxy_key(attempt.egress["proxy"]),))
+        handle_attempt_failure(attempt)
+    return None
+
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
+    spool = None
     try:
         auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
         if not auth_token:
@@ -1335,81 +3527,205 @@ def chat_completions():
         elif auth_token != CONFIG["API"]["API_KEY"]:
             return jsonify({"error": 'Unauthorized'}), 401
 
-        data = request.json
-        model = data.get("model")
-        stream = data.get("stream", False)
-
-        grok_client = GrokApiClient(model)
-        request_payload = grok_client.prepare_chat_request(data)
+        spool = ImageSpool()
+        try:
+            data = Utils.decode_json(spool.read_request(request.stream))
+        except ValueError:
+            data = None
+        validation_error = Utils.validate_chat_request(data)
+        if validation_error:
+            spool.close()
+            return jsonify({
+                "error": {
+                    "message": validation_error,
+                    "type": "invalid_request_error"
+                }
+            }), 400
 
-        logger.info(json.dumps(request_payload, indent=2))
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key and CONFIG["IDEMPOTENCY"]["ENABLED"]:
+            return complete_idempotent_chat(data, auth_token, spool, idempotency_key)
+        if CONFIG["SINGLE_FLIGHT"]["ENABLED"] and not data.get("stream", False):
+            return complete_single_flight_chat(data, auth_token, spool)
+        return complete_chat(data, auth_token, spool)
 
-        while token_manager.get_token_count_for_model(model) > 0:
-            current_token = Utils.create_auth_headers(model)
-            if not current_token:
-                logger.warning("轮询结束，未找到可用令牌。", "Server")
-                break
+    except Exception as error:
+        if spool:
+            spool.close()
+        logger.error(f"chat_completions 外部发生异常: {str(error)}", "ChatAPI")
+        return jsonify({
+            "error": {
+                "message": str(error),
+                "type": "server_error"
+            }
+        }), 500
 
-            CONFIG["API"]["SIGNATURE_COOKIE"] = current_token
-            logger.info(f"正在尝试令牌: {json.dumps(current_token, indent=2)}", "Server")
+def complete_chat(data, auth_token, spool, detached=False, record=None):
+    """执行一次对话请求并返回响应；detached为True时流式响应不绑定请求上下文，可在后台线程中读取；
+    record为幂等记录，结果不可重放时在其上标记"""
+    model = data.get("model")
+    stream = data.get("stream", False)
+
+    grok_client = GrokApiClient(model)
+    grok_client.spool = spool
+    usage_context = {
+        "api_key": auth_token,
+        "prompt_tokens": grok_client.estimate_prompt_tokens(data),
+        "include": bool((data.get("stream_options") or {}).get("include_usage"))
+    }
+    cache_key = None
+    if ResponseCache.get_ttl(model):
+        cache_key = ResponseCache.get_key(auth_token, grok_client, data, spool)
+        content = response_cache.get(cache_key)
+        if content is not None:
+            # 命中时不获取令牌、不请求上游；流式请求以单个分块重放
+            spool.close()
+            logger.info(f"命中回复缓存: 模型 {model}", "ResponseCache")
+            usage = UsageTracker.build_usage(usage_context["prompt_tokens"], ContextPacker.estimate_tokens(content))
+            if stream:
+                encoder = StreamChunkEncoder(model, usage_context["include"])
+                events = [encoder.encode(content)]
+                if usage_context["include"]:
+                    events.append(encoder.encode_usage(usage))
+                events.append(StreamChunkEncoder.DONE)
+                response = Response(events, content_type='text/event-stream')
+            else:
+                response = jsonify(MessageProcessor.create_chat_response(content, model, usage=usage))
+            response.headers["X-Response-Cache"] = "hit"
+            return response
+    grok_client.prefetch_images(data)
+    grok_client.continuation = grok_client.prepare_continuation(data)
+
+    while True:
+        attempt = open_upstream(model, grok_client, data)
+        if not attempt:
+            break
 
-            if CONFIG['SERVER']['CF_CLEARANCE']:
-                CONFIG["SERVER"]['COOKIE'] = f"{current_token};{CONFIG['SERVER']['CF_CLEARANCE']}"
+        try:
+            if stream:
+                reconnect = lambda: open_upstream(model, grok_client, data)
+                # 合并窗口：请求的stream_options.coalesce_ms优先，否则使用全局SSE_COALESCE_MS
+                coalesce_ms = (data.get("stream_options") or {}).get("coalesce_ms", CONFIG["STREAM"]["COALESCE_MS"])
+                events = handle_stream_response(attempt, model, reconnect, coalesce_ms, usage_context)
+                response = Response(events if detached else stream_with_context(events), content_type='text/event-stream')
+                # 流式输出中失败重连可能需要重新上传图片，临时文件在响应结束后再删除
+                response.call_on_close(spool.close)
+                return response
             else:
-                CONFIG["SERVER"]['COOKIE'] = current_token
+                content = handle_non_stream_response(attempt, model)
+                spool.close()
+                usage = UsageTracker.build_usage(usage_context["prompt_tokens"], ContextPacker.estimate_tokens(content))
+                usage_tracker.record(auth_token, attempt.token, model, usage)
+                response = jsonify(MessageProcessor.create_chat_response(content, model, usage=usage))
+                if attempt.upstream_error:
+                    # 上游错误帧同样以200返回，但不保存重放，重试时重新请求
+                    if record:
+                        record.storable = False
+                elif cache_key:
+                    response_cache.put(cache_key, model, content)
+                return response
+
+        except UpstreamTimeout as e:
+            logger.error(f"请求处理时超时: {str(e)}，切换令牌", "Server")
+            attempt.close()
+            if CONFIG["API"]["IS_CUSTOM_SSO"]:
+                raise
 
-            try:
-                proxy_options = Utils.get_proxy_options()
-                response = curl_requests.post(
-                    f"{CONFIG['API']['BASE_URL']}/rest/app-chat/conversations/new",
-                    headers={**DEFAULT_HEADERS, "Cookie": CONFIG["SERVER"]['COOKIE']},
-                    data=json.dumps(request_payload),
-                    impersonate="chrome133a",
-                    stream=True,
-                    **proxy_options
-                )
-
-                if response.status_code == 200:
-                    logger.info("请求成功", "Server")
-                    if stream:
-                        return Response(stream_with_context(handle_stream_response(response, model)), content_type='text/event-stream')
-                    else:
-                        content = handle_non_stream_response(response, model)
-                        return jsonify(MessageProcessor.create_chat_response(content, model))
-
-                # 任何非200状态码都标记token为无效（悲观策略）
-                logger.warning(f"令牌请求失败，状态码: {response.status_code}，标记token为无效", "Server")
-                if CONFIG["API"]["IS_CUSTOM_SSO"]:
-                    raise ValueError(f"自定义SSO令牌当前模型{model}的请求次数已失效")
-
-                token_manager.mark_token_invalid(model, current_token, f"HTTP {response.status_code}")
-                continue
+            token_manager.cool_down_token(model, attempt.token, str(e))
+            continue
+        except Exception as e:
+            logger.error(f"请求处理时发生异常: {str(e)}，标记token为无效", "Server")
+            attempt.close()
+            if CONFIG["API"]["IS_CUSTOM_SSO"]:
+                raise
+            
+            token_manager.mark_token_invalid(model, attempt.token, f"异常: {str(e)}")
+            continue
 
-            except Exception as e:
-                logger.error(f"请求处理时发生异常: {str(e)}，标记token为无效", "Server")
-                if CONFIG["API"]["IS_CUSTOM_SSO"]:
-                    raise
-                
-                token_manager.mark_token_invalid(model, current_token, f"异常: {str(e)}")
-                continue
+    # After the loop, if no token was successful
+    spool.close()
+    logger.error(f"模型 {model} 所有可用令牌均尝试失败", "ChatAPI")
+    return jsonify({
+        "error": {
+            "message": f"当前模型 {model} 所有令牌暂无可用，请稍后重试",
+            "type": "server_error"
+        }
+    }), 500
 
-        # After the loop, if no token was successful
-        logger.error(f"模型 {model} 所有可用令牌均尝试失败", "ChatAPI")
+def pump_response(key, record, response):
+    """后台读取流式响应写入幂等记录，与发起请求的客户端是否断开无关"""
+    try:
+        for data in response.response:
+            # 心跳不写入记录，挂接的读取方各自发送
+            if data and not data.startswith(b':'):
+                record.append(data)
+    except Exception as error:
+        logger.error(f"读取流式响应失败: {str(error)}", "Idempotency")
+    finally:
+        response.close()
+        completed = bool(record.events) and record.events[-1].endswith(StreamChunkEncoder.DONE)
+        record.finish(response.status_code, response.content_type, completed)
+        idempotency_store.complete(key, record)
+
+def complete_idempotent_chat(data, auth_token, spool, idempotency_key):
+    """带Idempotency-Key的请求：同一密钥只请求一次上游，重复请求挂接进行中的输出或重放已完成的响应"""
+    key = IdempotencyStore.get_key(auth_token, idempotency_key)
+    record, is_owner = idempotency_store.begin(key, IdempotencyStore.get_fingerprint(data, spool))
+    if record is None:
+        spool.close()
         return jsonify({
             "error": {
-                "message": f"当前模型 {model} 所有令牌暂无可用，请稍后重试",
-                "type": "server_error"
+                "message": "Idempotency-Key已用于不同的请求",
+                "type": "invalid_request_error"
             }
-        }), 500
+        }), 422
+    if not is_owner:
+        spool.close()
+        logger.info("幂等请求命中，使用已有响应", "Idempotency")
+        response = record.build_response(CONFIG["STREAM"]["HEARTBEAT"])
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
 
+    try:
+        response = app.make_response(complete_chat(data, auth_token, spool, detached=True, record=record))
     except Exception as error:
-        logger.error(f"chat_completions 外部发生异常: {str(error)}", "ChatAPI")
-        return jsonify({
-            "error": {
-                "message": str(error),
-                "type": "server_error"
-            }
-        }), 500
+        record.append(json.dumps({"error": {"message": str(error), "type": "server_error"}}).encode('utf-8'))
+        record.finish(500, 'application/json', storable=False)
+        idempotency_store.complete(key, record)
+        raise
+
+    if response.mimetype == 'text/event-stream':
+        # 上游输出由后台线程读取，客户端断开重试时可挂接到同一输出
+        record.start(response.status_code, response.content_type)
+        threading.Thread(target=pump_response, args=(key, record, response), daemon=True).start()
+        return Response(record.iter_events(CONFIG["STREAM"]["HEARTBEAT"]), content_type=response.content_type)
+
+    record.append(response.get_data())
+    record.finish(response.status_code, response.content_type, response.status_code < 500)
+    idempotency_store.complete(key, record)
+    return response
+
+def complete_single_flight_chat(data, auth_token, spool):
+    """相同请求正在执行时等待其结果，否则由本请求执行并把结果分发给等待者"""
+    key = SingleFlight.get_key(auth_token, data, spool)
+    record, is_owner = single_flight.begin(key)
+    if not is_owner:
+        spool.close()
+        logger.info("相同请求正在进行，等待共用其结果", "SingleFlight")
+        return record.build_response()
+
+    try:
+        response = app.make_response(complete_chat(data, auth_token, spool))
+    except Exception as error:
+        record.append(json.dumps({"error": {"message": str(error), "type": "server_error"}}).encode('utf-8'))
+        record.finish(500, 'application/json')
+        single_flight.complete(key, record)
+        raise
+
+    record.append(response.get_data())
+    record.finish(response.status_code, response.content_type)
+    single_flight.complete(key, record)
+    return response
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -1418,6 +3734,18 @@ def catch_all(path):
 
 if __name__ == '__main__':
     token_manager = AuthTokenManager()
+    cf_pool = CfClearancePool()
+    cookie_jar = CookieJarManager()
+    request_hedger = RequestHedger()
+    conversation_cache = ConversationCache()
+    upload_cache = UploadCache()
+    usage_tracker = UsageTracker()
+    idempotency_store = IdempotencyStore()
+    single_flight = SingleFlight()
+    response_cache = ResponseCache()
+    upload_executor = ThreadPoolExecutor(max_workers=CONFIG["API"]["UPLOAD_CONCURRENCY"])
+    image_fetcher = ImageFetcher()
+    fetch_executor = ThreadPoolExecutor(max_workers=CONFIG["IMAGE_FETCH"]["CONCURRENCY"])
     initialization()
 
     app.run(
@@ -0,0 +1,44 @@
+"""请求体解码基准：json.loads（旧流程）与Utils.decode_json（安装orjson时使用orjson）
+
+用法: python bench/bench_decode_request.py
+请求体为带一张约10MB base64图片的视觉请求，与chat_completions收到的原始字节一致。
+"""
+import base64
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("SHOW_THINKING", "false")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app  # noqa: E402
+
+ROUNDS = 20
+
+
+def build_body():
+    image = base64.b64encode(os.urandom(7 * 1024 * 1024)).decode("ascii")
+    return json.dumps({
+        "model": "grok-3",
+        "stream": False,
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "描述这张图片"},
+            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image}"}}
+        ]}]
+    }).encode("utf-8")
+
+
+def main():
+    body = build_body()
+    print(f"请求体 {len(body) / 1e6:.1f}MB，orjson: {'已安装' if app.orjson else '未安装'}")
+    assert json.loads(body) == app.Utils.decode_json(body)
+    assert app.Utils.validate_chat_request(app.Utils.decode_json(body)) is None
+    for name, func in (("json.loads", json.loads), ("Utils.decode_json", app.Utils.decode_json)):
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            func(body)
+        print(f"{name}: {(time.perf_counter() - start) / ROUNDS * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
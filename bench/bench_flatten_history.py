@@ -0,0 +1,74 @@
+"""历史消息扁平化基准：逐条字符串拼接（旧流程）与单次遍历+ContextPacker（当前prepare_chat_request）
+
+用法: python bench/bench_flatten_history.py
+只含文本消息；溢出到message.txt的上传替换为返回固定文件ID，不访问网络。
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("SHOW_THINKING", "false")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app  # noqa: E402
+
+CASES = [(10, 2_000_000), (100, 2_000_000), (2000, 4_000_000)]
+
+
+def build_request(count, total_chars):
+    per_message = total_chars // count
+    roles = ["user", "assistant", "assistant", "user"]
+    messages = [{"role": roles[index % 4], "content": "x" * per_message} for index in range(count)]
+    messages.append({"role": "user", "content": "last"})
+    return {"model": "grok-3", "messages": messages}
+
+
+def flatten_old(client, request):
+    """旧版prepare_chat_request的文本部分：+=拼接，同角色合并时rindex重建整段字符串"""
+    todo_messages = request["messages"]
+    messages = ''
+    last_role = None
+    last_content = ''
+    message_length = 0
+    convert_to_file = False
+    last_message_content = ''
+    for current in todo_messages:
+        role = 'assistant' if current["role"] == 'assistant' else 'user'
+        is_last_message = current == todo_messages[-1]
+        text_content = client.process_content(current.get("content", ""))
+        if is_last_message and convert_to_file:
+            last_message_content = f"{role.upper()}: {text_content or '[图片]'}\n"
+            continue
+        if text_content:
+            if role == last_role:
+                last_content += '\n' + text_content
+                messages = messages[:messages.rindex(f"{role.upper()}: ")] + f"{role.upper()}: {last_content}\n"
+            else:
+                messages += f"{role.upper()}: {text_content}\n"
+                last_content = text_content
+                last_role = role
+        message_length += len(messages)
+        if message_length >= 40000:
+            convert_to_file = True
+    return messages, last_message_content
+
+
+def main():
+    app.cf_pool = app.CfClearancePool()
+    app.upload_executor = ThreadPoolExecutor(max_workers=4)
+    app.GrokApiClient.upload_base64_file = lambda self, message, model: "file-id"
+    for count, total_chars in CASES:
+        request = build_request(count, total_chars)
+        client = app.GrokApiClient("grok-3")
+        start = time.perf_counter()
+        flatten_old(client, request)
+        old_ms = (time.perf_counter() - start) * 1000
+        client = app.GrokApiClient("grok-3")
+        start = time.perf_counter()
+        client.prepare_chat_request(request)
+        new_ms = (time.perf_counter() - start) * 1000
+        print(f"{count}条 / {total_chars / 1e6:g}MB: 旧 {old_ms:.1f} ms -> 当前 {new_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""remove_think_tags基准：两次正则替换（旧实现）与单次扫描（当前实现）
+
+用法: python bench/bench_remove_think_tags.py
+先用随机片段比对两者输出，再在含4张5MB内联图片和思考块的历史文本上计时。
+"""
+import os
+import random
+import re
+import sys
+import time
+
+os.environ.setdefault("SHOW_THINKING", "false")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app  # noqa: E402
+
+UNITS = ["hello ", " ", "\n", "<think>r\nr</think>", "<think>", "</think>", "![image](data:image/png;base64,QUJD)",
+         "![image](data:image/png;base64,QU\nJD)", "![image](http://x)", "(", ")", "ok"]
+
+
+def remove_think_tags_old(text):
+    text = re.sub(r'<think>[\s\S]*?<\/think>', '', text).strip()
+    text = re.sub(r'!\[image\]\(data:.*?base64,.*?\)', '[图片]', text)
+    return text
+
+
+def main():
+    remove_think_tags = app.GrokApiClient.remove_think_tags
+    random.seed(5)
+    for _ in range(50000):
+        text = "".join(random.choice(UNITS) for _ in range(random.randint(0, 10)))
+        assert remove_think_tags_old(text) == remove_think_tags(text), repr(text)
+    print("随机片段输出一致")
+
+    blob = "A" * (5 * 1024 * 1024)
+    text = "".join(f"turn {index} <think>reasoning {index}</think> see ![image](data:image/png;base64,{blob}) ok\n" for index in range(4))
+    for name, func in (("正则", remove_think_tags_old), ("单次扫描", remove_think_tags)):
+        start = time.perf_counter()
+        func(text)
+        print(f"{name}: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
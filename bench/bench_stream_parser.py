@@ -0,0 +1,74 @@
+"""流式响应解析基准：逐帧解析+打印（旧流程）与字节预筛+StreamParser（当前流程）
+
+用法: python bench/bench_stream_parser.py [NDJSON文件] [模型]
+默认使用bench/fixtures/grok4_stream.ndjson：按grok.com上游的帧结构构造的脱敏样例
+（会话帧、userResponse、带responseId的思考/回答帧、finalMetadata、modelResponse、标题帧），
+内容为占位文本。可以传入自己抓取的上游流（每行一个原始帧）替换。
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("SHOW_THINKING", "false")
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+import app  # noqa: E402
+
+DEFAULT_FIXTURE = os.path.join(BENCH_DIR, "fixtures", "grok4_stream.ndjson")
+ROUNDS = 500
+
+
+def load_frames(path):
+    with open(path, 'rb') as f:
+        return [line.rstrip(b'\r\n') for line in f if line.strip()]
+
+
+def run_old(frames, model):
+    parser = app.StreamParser(model)
+    output = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for chunk in frames:
+            line_json = json.loads(chunk.decode("utf-8").strip())
+            print(line_json)
+            response = line_json.get("result", {}).get("response")
+            if response:
+                token, _ = parser.feed(response)
+                if token:
+                    output.append(token)
+    return output
+
+
+def run_new(frames, model):
+    parser = app.StreamParser(model)
+    output = []
+    for chunk in frames:
+        if parser.should_skip(chunk):
+            continue
+        response = app.Utils.decode_json(chunk).get("result", {}).get("response")
+        if response:
+            token, _ = parser.feed(response)
+            if token:
+                output.append(token)
+    return output
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FIXTURE
+    model = sys.argv[2] if len(sys.argv) > 2 else "grok-4"
+    frames = load_frames(path)
+    assert run_old(frames, model) == run_new(frames, model)
+    parser = app.StreamParser(model)
+    skipped = sum(1 for chunk in frames if parser.should_skip(chunk))
+    print(f"{os.path.basename(path)}: {len(frames)}帧，预筛跳过{skipped}帧，模型 {model}")
+    for func in (run_old, run_new):
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            func(frames, model)
+        print(f"{func.__name__}: {(time.perf_counter() - start) / ROUNDS * 1e6:.0f} µs/流")
+
+
+if __name__ == "__main__":
+    main()
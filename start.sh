@@ -64,7 +64,7 @@ main() {
   echo -e "${GREEN}安装依赖...${RESET}"
   pip install --no-cache-dir \
       flask flask_cors requests curl_cffi \
-      werkzeug datetime python-dotenv loguru
+      werkzeug datetime python-dotenv loguru orjson pillow
 
   if [ $? -ne 0 ]; then
       echo -e "${RED}依赖安装失败${RESET}"